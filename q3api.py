@@ -0,0 +1,415 @@
+"""Stats service: one warm Q3LogParse, served as JSON over HTTP
+
+The engine parses the log once, then follows q3log (and compaction of it) every
+few seconds, so scripts, a web scoreboard and the bot (with stats_backend=api)
+share its aggregates instead of each replaying the log. Responses are cached
+until another game finishes, and carry an ETag, so clients that send it back
+with If-None-Match get a 304 without anything being computed.
+
+GET endpoints, all with an optional ?since=all|today|week|<date/time>:
+    /overview                 games, first game, and players by win rate
+    /meta                     player_meta, with games and wins as counts
+    /player/<name>            one player's record, kills, deaths and weapons
+    /map/<name>?count=10      best total scores on a map
+    /h2h/<player>/<target>    head-to-head kills, and who finished ahead
+    /recent?count=10          the last finished games (no since)
+    /metrics                  Prometheus metrics
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
+from urllib.request import Request, urlopen
+
+from dateutil.parser import parse
+
+from q3constants import CONFIG, TZ, parse_since, redis_client, server_key
+from q3metrics import Counter, Histogram, render
+from q3parselog import LOG_KEY, TRIMMED_KEY, Q3LogParse, count_wins
+
+logger = logging.getLogger(__name__)
+
+REQUESTS = Counter("q3api_requests_total", "Requests served", ["endpoint", "status"])
+REQUEST_TIME = Histogram("q3api_request_seconds", "Time to answer a request", ["endpoint"])
+REFRESH_TIME = Histogram("q3api_refresh_seconds", "Time to catch up on the log", ["kind"])
+
+CACHE_SIZE = 256  # responses kept per generation
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class StatsEngine(object):
+    """A Q3LogParse kept up to date from Redis
+
+    Requests read `current`, a (generation, snapshot of the finished games) that's
+    replaced whenever another game finishes, so they never wait for the parser.
+    """
+
+    def __init__(self, r, server=None):
+        self.r = r
+        self.server = server
+        self.log_key = server_key(LOG_KEY, server)
+        self.trimmed_key = server_key(TRIMMED_KEY, server)
+        self.parsed = None
+        self.position = 0  # log offset of the next line to parse
+        self.generation = 0
+        self.current = (0, None)
+
+    def publish(self):
+        self.generation += 1
+        self.current = (self.generation, self.parsed.snapshot())
+
+    def load(self):
+        """Parse everything from scratch"""
+        with REFRESH_TIME.time(kind="load"):
+            self.parsed = Q3LogParse(self.r, server=self.server)
+            self.position = self.parsed.parse_log()
+            self.publish()
+        logger.info(f"Loaded {self.parsed.game_count()} games, log at {self.position}")
+
+    def refresh(self):
+        """Parse lines logged since the last call; True if another game finished"""
+        if self.parsed is None:
+            self.load()
+            return True
+
+        trimmed = int(self.r.get(self.trimmed_key) or 0)
+        if trimmed > self.position:  # compacted past lines we hadn't read
+            self.load()
+            return True
+
+        with REFRESH_TIME.time(kind="follow"):
+            pipe = self.r.pipeline()
+            pipe.get(self.trimmed_key)
+            pipe.lrange(self.log_key, self.position - trimmed, -1)
+            trimmed_, lines = pipe.execute()
+            if int(trimmed_ or 0) != trimmed:  # compacted in between, try again
+                return self.refresh()
+
+            version = self.parsed.version
+            self.parsed.parse_lines(lines, self.position)
+            self.position += len(lines)
+            if self.parsed.version == version:
+                return False
+            self.parsed.drop_orphans()
+            self.publish()
+        return True
+
+    def follow(self, interval):
+        while True:
+            try:
+                self.refresh()
+            except Exception as ex:
+                logger.exception("Couldn't refresh the stats", exc_info=ex)
+            time.sleep(interval)
+
+
+def since_param(query):
+    """The since of a query: all, today, week, or a date/time"""
+    value = query.get("since", ["all"])[0]
+    if value in ("all", ""):
+        return None
+    if value in ("today", "week"):
+        since = parse_since(value)
+    else:
+        try:
+            since = parse(value)
+        except ValueError:
+            raise BadRequest(f"can't parse since={value}") from None
+    return TZ.localize(since) if since.tzinfo is None else since
+
+
+def count_param(query, default=10):
+    try:
+        count = int(query.get("count", [default])[0])
+    except ValueError:
+        raise BadRequest("count must be a number") from None
+    return max(1, min(count, 100))
+
+
+def iso(ts):
+    return ts.isoformat() if ts is not None else None
+
+
+def game_json(ts, game):
+    return {
+        "started": iso(ts),
+        "ended": iso(game.get("ended")),
+        "mapname": game["mapname"],
+        "reason": game.get("reason"),
+        "fraglimit": game.get("fraglimit"),
+        "scores": game["scores"],
+        "winners": game["winners"],
+    }
+
+
+def meta_counts(view, since):
+    """player_meta, with games and wins as counts like SQLiteStats"""
+    plkill, plgames, plweapons = view.player_meta(since)
+    counts = {
+        pl: {
+            "games": len(data["games"]),
+            "wins": len(data.get("wins", list())),
+            "mapscore": data["mapscore"],
+        }
+        for pl, data in plgames.items()
+    }
+    return plkill, counts, plweapons
+
+
+def overview(view, query):
+    since = since_param(query)
+    _, plgames, _ = meta_counts(view, since)
+    return {
+        "since": iso(since),
+        "first_game": iso(view.first_game()),
+        "games": view.game_count(since),
+        "players": [
+            {"player": pl, "win_rate": frac, "wins": wins, "games": games, "best_map": bestmap}
+            for pl, (frac, wins, games, bestmap) in count_wins(plgames).items()
+        ],
+    }
+
+
+def meta(view, query):
+    plkill, plgames, plweapons = meta_counts(view, since_param(query))
+    return {"kills": plkill, "games": plgames, "weapons": plweapons}
+
+
+def player(view, query, name):
+    plkill, plgames, plweapons = meta_counts(view, since_param(query))
+    if name not in plgames:
+        return None
+    frac, wins, games, bestmap = count_wins({name: plgames[name]})[name]
+    kills = plkill.get(name, dict())
+    return {
+        "player": name,
+        "games": games,
+        "wins": wins,
+        "win_rate": frac,
+        "best_map": bestmap,
+        "map_scores": plgames[name]["mapscore"],
+        "kills": {tgt: n for tgt, n in kills.items() if tgt != name},
+        "deaths": {pl: dtgt[name] for pl, dtgt in plkill.items() if pl != name and name in dtgt},
+        "suicides": kills.get(name, 0),
+        "weapons": plweapons.get(name, dict()),
+    }
+
+
+def map_board(view, query, mapname):
+    rows = view.map_leaderboard(mapname, since_param(query), count_param(query))
+    return {
+        "mapname": mapname,
+        "players": [
+            {"player": pl, "score": score, "games": games, "wins": wins}
+            for pl, score, games, wins in rows
+        ],
+    }
+
+
+def head_to_head(view, query, name, target):
+    sides = {pl: {"kills": 0, "weapons": dict(), "ahead": 0} for pl in (name, target)}
+    together = 0
+    for _, game in view.finished_games(since_param(query)):
+        for pl, tgt in ((name, target), (target, name)):
+            sides[pl]["kills"] += game["kills"].get(pl, dict()).get(tgt, 0)
+            # not in games compacted before duels were added
+            duels = game.get("duels", dict()).get(pl, dict()).get(tgt, dict())
+            for mod, kills in duels.items():
+                sides[pl]["weapons"][mod] = sides[pl]["weapons"].get(mod, 0) + kills
+        scores = game["scores"]
+        if name in scores and target in scores:
+            together += 1
+            if scores[name] != scores[target]:
+                sides[max((name, target), key=scores.get)]["ahead"] += 1
+    return {"games": together, "players": sides}
+
+
+def recent(view, query):
+    starts = view.starts[-count_param(query) :]
+    return {"games": [game_json(ts, view.games[ts]) for ts in reversed(starts)]}
+
+
+# endpoint -> (number of path arguments, function of (view, query, *args))
+ENDPOINTS = {
+    "overview": (0, overview),
+    "meta": (0, meta),
+    "player": (1, player),
+    "map": (1, map_board),
+    "h2h": (2, head_to_head),
+    "recent": (0, recent),
+}
+
+
+class StatsAPI(object):
+    """Answers requests from an engine's current snapshot, with caching"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        # tells apart generations of another run of the service
+        self.run_id = f"{int(time.time()):x}"
+        self.lock = threading.Lock()
+        self.cache = dict()  # path -> body
+        self.cache_generation = None
+
+    def respond(self, path, etag=None):
+        """(status, ETag or None, body bytes) for a GET of path"""
+        url = urlsplit(path)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        nargs, func = ENDPOINTS.get(parts[0], (None, None))
+        if func is None or len(parts) != nargs + 1:
+            return 404, None, json.dumps({"error": "no such endpoint"}).encode("utf-8")
+
+        generation, view = self.engine.current
+        if view is None:
+            return 503, None, json.dumps({"error": "still loading"}).encode("utf-8")
+        etag_ = f'"{self.run_id}.{generation}"'
+        if etag == etag_:
+            return 304, etag_, b""
+
+        with self.lock:
+            if self.cache_generation != generation or len(self.cache) >= CACHE_SIZE:
+                self.cache = dict()
+                self.cache_generation = generation
+            body = self.cache.get(path)
+        if body is not None:
+            return 200, etag_, body
+
+        try:
+            data = func(view, parse_qs(url.query), *parts[1:])
+        except BadRequest as ex:
+            return 400, None, json.dumps({"error": str(ex)}).encode("utf-8")
+        if data is None:
+            return 404, None, json.dumps({"error": "not found"}).encode("utf-8")
+
+        body = json.dumps(data).encode("utf-8")
+        with self.lock:
+            if self.cache_generation == generation:
+                self.cache[path] = body
+        return 200, etag_, body
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] == "/metrics":
+            self.reply(200, None, render().encode("utf-8"), "text/plain; version=0.0.4")
+            return
+
+        endpoint = self.path.split("?")[0].strip("/").split("/")[0]
+        endpoint = endpoint if endpoint in ENDPOINTS else "unknown"
+        with REQUEST_TIME.time(endpoint=endpoint):
+            status, etag, body = self.server.api.respond(
+                self.path, self.headers.get("If-None-Match")
+            )
+            self.reply(status, etag, body, "application/json")
+        REQUESTS.inc(endpoint=endpoint, status=status)
+
+    def reply(self, status, etag, body, content_type):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if status != 304:
+            self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class StatsClient(object):
+    """Stats backend for StatsPages and map leaderboards, from a running service
+
+    Has the same player_meta/player_wins/first_game/game_count/map_leaderboard as
+    SQLiteStats. Responses are kept, and revalidated with their ETag.
+    """
+
+    def __init__(self, url=None, timeout=5):
+        """
+        Args:
+            url: Service URL, defaults to stats_url from the config
+            timeout: Seconds to wait for a response
+        """
+        self.url = (url or CONFIG.get("stats_url", "http://q3statsapi:9103")).rstrip("/")
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.cache = dict()  # url -> (ETag, data)
+
+    def get(self, path, **params):
+        """GET a path, with params like since as query parameters; raises OSError"""
+        params = {k: iso(v) if hasattr(v, "isoformat") else v for k, v in params.items()}
+        params = {k: v for k, v in params.items() if v is not None}
+        url = f"{self.url}/{path}" + (f"?{urlencode(params)}" if any(params) else "")
+        with self.lock:
+            etag, data = self.cache.get(url, (None, None))
+
+        request = Request(url)
+        if etag is not None:
+            request.add_header("If-None-Match", etag)
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                data = json.load(response)
+                etag = response.headers.get("ETag")
+        except HTTPError as ex:
+            if ex.code != 304:
+                raise
+        with self.lock:
+            self.cache[url] = (etag, data)
+        return data
+
+    def player_meta(self, since=None):
+        data = self.get("meta", since=since)
+        return data["kills"], data["games"], data["weapons"]
+
+    def player_wins(self, plgames):
+        return count_wins(plgames)
+
+    def first_game(self):
+        first = self.get("overview")["first_game"]
+        return parse(first) if first is not None else None
+
+    def game_count(self, since=None):
+        return self.get("overview", since=since)["games"]
+
+    def map_leaderboard(self, mapname, since=None, count=10):
+        data = self.get(f"map/{quote(mapname, safe='')}", since=since, count=count)
+        return [(row["player"], row["score"], row["games"], row["wins"]) for row in data["players"]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve stats as JSON over HTTP")
+    parser.add_argument("--host", default=CONFIG.get("api_host", ""), help="address to bind")
+    parser.add_argument("--port", type=int, default=int(CONFIG.get("api_port", "9103")))
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=float(CONFIG.get("api_refresh_seconds", "2")),
+        help="seconds between checks for new log lines",
+    )
+    parser.add_argument("--server", help="game server name, when following several")
+    args = parser.parse_args()
+
+    engine = StatsEngine(redis_client(), args.server)
+    engine.load()
+    threading.Thread(
+        target=engine.follow, args=(args.interval,), name="q3api-follow", daemon=True
+    ).start()
+
+    server = ThreadingHTTPServer((args.host, args.port), StatsHandler)
+    server.daemon_threads = True
+    server.api = StatsAPI(engine)
+    logger.info(f"Serving stats on {args.host or '*'}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
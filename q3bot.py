@@ -1,40 +1,275 @@
+import asyncio
 from asyncio import sleep
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import json
 import logging
 from pathlib import Path
 import random
+import socket
+import threading
+import time
 
-from bspp import bspp
+import aiohttp
 from dateutil.parser import parse
 import discord
 from discord.ext import commands
-import paho.mqtt.client as mqtt
-from xrcon.client import XRcon
-
-from q3constants import BOTS, IX_WORLD, MAP_ROTATIONS, STYLE_EMOJI, TZ, parse_since
-from q3parselog import Q3LogParse, render_name
-
-logging.basicConfig(
-    filename="discord.log",
-    level=logging.ERROR,
-    format="[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s",
-    datefmt="%H:%M:%S",
+import redis
+
+from q3api import StatsClient
+from q3constants import (
+    BOTS,
+    IX_WORLD,
+    MAP_ROTATIONS,
+    MOD_TO_WEAPON,
+    STYLE_EMOJI,
+    TZ,
+    SpillList,
+    async_redis_client,
+    get_config,
+    parse_since,
+    redis_client,
+    server_key,
+    setup_logging,
+)
+from q3index import (
+    PlayerIndex,
+    RatingIndex,
+    VersusIndex,
+    render_ladder,
+    render_player,
+    render_versus,
 )
-# set up logging to console
-console = logging.StreamHandler()
-console.setLevel(logging.DEBUG)
-# set a format which is simpler for console use
-formatter = logging.Formatter("[%(asctime)s] %(name)-12s: %(levelname)-8s %(message)s")
-console.setFormatter(formatter)
-# add the handler to the root logger
-logging.getLogger("").addHandler(console)
+from q3metrics import Counter, Gauge, Histogram, start_server
+from q3parselog import (
+    Q3LogParse,
+    StatsPages,
+    events_since,
+    find_winners,
+    render_leaderboard,
+    render_name,
+    render_winners,
+)
+from q3profile import Profiler
+from q3sqlite import SQLiteStats
+from q3stream import StreamConsumer, entry_object
 
 logger = logging.getLogger(__name__)
 
 MAP_IGNORE_FILE = ".mapignore"
 NEWGAME_COOLDOWN = timedelta(seconds=30)
+STATUS_REFRESH = 10  # seconds between rcon status checks while there's no map
+STATE_KEY = "q3bot:state"  # snapshot of the live game state
+OUTBOUND_KEY = "q3bot:outbound"  # chat spilled while Discord is slow or down
+CHATTER = "chatter"  # chat kinds: play-by-play, only worth sending while it's fresh
+RESULT = "result"  # game results and anything asked for, always sent
+
+EVENTS = Counter("q3bot_events_total", "Log events received", ["action"])
+QUEUE_DEPTH = Gauge("q3bot_outbound_queue_depth", "Messages waiting to be sent to Discord")
+LANE_LATENCY = Histogram(
+    "q3bot_lane_latency_seconds", "Time from queueing an action to starting it", ["lane"]
+)
+LANE_DROPPED = Counter("q3bot_lane_dropped_total", "Queued items dropped", ["lane", "reason"])
+LANE_SPILLED = Counter("q3bot_lane_spilled_total", "Queued items spilled to Redis", ["lane"])
+SEND_TIME = Histogram("q3bot_discord_send_seconds", "Discord message send latency")
+RCON_TIME = Histogram("q3bot_rcon_seconds", "rcon round-trip time", ["command"])
+RCON_TIMEOUTS = Counter("q3bot_rcon_timeouts_total", "rcon commands timed out", ["command"])
+STATS_TIME = Histogram("q3bot_stats_seconds", "Time to compute !stats", ["stage"])
+STATS_RUNNING = Gauge("q3bot_stats_running", "Stats computations running or waiting")
+STATS_REFUSED = Counter("q3bot_stats_refused_total", "Stats requests refused", ["reason"])
+
+
+class StatsBusy(commands.CommandError):
+    """The stats pool is full, or a computation timed out; the message is for the user"""
+
+
+class Retry(Exception):
+    """Raised by a lane handler to put its item back at the front, and back off"""
+
+
+class Lane(object):
+    """Items queued from any thread, handled in order by one task on the event loop
+
+    Each lane is run by its own task, so a slow lane (Discord rate limits on chat)
+    never holds up another (adding bots when a player joins).
+
+    With maxsize, at most that many items are kept in memory. When full, put()
+    spills to a Redis list if given a client (a SpillList, like q3container's
+    StageQueue), or else drops the oldest item that expires, or the oldest.
+    """
+
+    def __init__(
+        self, name, poll=0.01, maxsize=None, expires=None, r=None, spill_key=None, backoff=5
+    ):
+        """
+        Args:
+            name: Lane name, for metrics and logs
+            poll: Seconds to sleep when there's nothing to do
+            maxsize: Max items in memory, default no limit
+            expires: Called with an item, returns the seconds it's worth handling
+                     for after being queued, or None if it never goes stale
+            r: Redis client, to spill to when full
+            spill_key: Redis list to spill to
+            backoff: Seconds to wait after a handler raises Retry
+        """
+        self.name = name
+        self.poll = poll
+        self.maxsize = maxsize
+        self.expires = expires
+        self.backoff = backoff
+        self.items = deque()  # (time queued, item)
+        self.lock = threading.Lock()
+        self.spill = SpillList(r, spill_key, f"{name} lane", self.lock) if r is not None else None
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        with self.lock:
+            full = self.maxsize is not None and len(self.items) >= self.maxsize
+            if self.spill is not None and (self.spill.spilling or full):
+                try:
+                    # wall clock time, so the age survives a restart
+                    self.spill.push([time.time(), item])
+                    LANE_SPILLED.inc(lane=self.name)
+                    return
+                except redis.RedisError:
+                    logger.exception(f"Can't spill the {self.name} lane")
+                    if not full:  # items are out of order now, but not lost
+                        self.items.append((time.monotonic(), item))
+                        return
+            if full:
+                self.drop_one()
+            self.items.append((time.monotonic(), item))
+
+    def drop_one(self):
+        """Make room, preferring items that go stale anyway"""
+        for ix, (_, item) in enumerate(self.items):
+            if self.expires is not None and self.expires(item) is not None:
+                del self.items[ix]
+                break
+        else:
+            self.items.popleft()
+        LANE_DROPPED.inc(lane=self.name, reason="full")
+
+    def unspill(self):
+        """Move spilled items back to memory, once it's empty; True if there were any"""
+        spilled = self.spill.pop(self.maxsize or 100)
+        offset = time.monotonic() - time.time()
+        for queued, item in spilled:
+            self.items.append((queued + offset, tuple(item) if isinstance(item, list) else item))
+        return any(spilled)
+
+    async def run(self, handler, idle=None, until=None):
+        """Await handler(item) for each item until until() is true
+
+        idle() is awaited whenever the lane is empty. Stale items are dropped, and
+        other errors are logged, so one failed item doesn't stop the lane.
+        """
+        while until is None or not until():
+            try:
+                try:
+                    queued, item = self.items.popleft()
+                except IndexError:
+                    # everything in memory predates the spill list
+                    spilling = self.spill is not None and self.spill.spilling
+                    if spilling and await asyncio.to_thread(self.unspill):
+                        continue
+                    if idle is not None:
+                        await idle()
+                    await sleep(self.poll)  # tiny sleep to avoid spamming CPU
+                    continue
+                age = time.monotonic() - queued
+                max_age = self.expires(item) if self.expires is not None else None
+                if max_age is not None and age > max_age:
+                    LANE_DROPPED.inc(lane=self.name, reason="stale")
+                    continue
+                LANE_LATENCY.observe(age, lane=self.name)
+                try:
+                    await handler(item)
+                except Retry:
+                    self.items.appendleft((queued, item))
+                    await sleep(self.backoff)
+            except Exception as ex:
+                logger.exception(f"{self.name} lane failed", exc_info=ex)
+
+
+class Ring(object):
+    """The last `size` items, in a list allocated up front; the oldest is overwritten"""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = [None] * size
+        self.next = 0  # slot for the next item
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, item):
+        self.items[self.next] = item
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def latest(self, n=None):
+        """Up to n of the most recent items, newest first"""
+        n = self.count if n is None else max(0, min(n, self.count))
+        return [self.items[(self.next - 1 - i) % self.size] for i in range(n)]
+
+
+def render_event(event):
+    """One line for an event in the recent events Ring"""
+    ts, kind, *fields = event
+    line = f"`{parse(ts).astimezone(TZ):%H:%M:%S}` "
+    if kind == "Kill":
+        killer, victim, weapon = fields
+        if killer is None or killer == victim:
+            return line + f"{render_name(victim)} died ({weapon})"
+        return line + f"{render_name(killer)} killed {render_name(victim)} ({weapon})"
+    elif kind == "Join":
+        return line + f"{render_name(fields[0])} joined"
+    elif kind == "Disconnect":
+        return line + f"{render_name(fields[0])} disconnected"
+    elif kind == "InitGame":
+        return line + f"Game started on {fields[0]}"
+    elif kind == "Exit":
+        return line + f"Game ended due to {fields[0]}"
+    return line + kind
+
+
+def new_game_record(mapname, started):
+    """What we keep of a game, from InitGame to ShutdownGame"""
+    return {
+        "mapname": mapname,
+        "started": started,
+        "scores": dict(),
+        "kills": dict(),
+        "weapons": dict(),
+    }
+
+
+def render_scoreboard(game):
+    """One message with a finished game, as kept in the last games Ring"""
+    title = f"**{game['mapname']}**"
+    if game["started"] is not None:
+        title += f" at {parse(game['started']).astimezone(TZ):%Y-%m-%d %H:%M}"
+    if "reason" in game:
+        title += f", ended due to {game['reason']}"
+    lines = [title, f"Won by {render_winners(find_winners(game['scores']))}"]
+    kills = game.get("kills", dict())
+    if any(kills):
+        leader = max(kills, key=kills.get)
+        weapons = game["weapons"]
+        weapon = max(weapons, key=weapons.get)
+        lines.append(
+            f"Most kills: {render_name(leader)} (_{kills[leader]}_),"
+            f" top weapon: {weapon} (_{weapons[weapon]}_ kills)"
+        )
+    ranked = sorted(game["scores"].items(), key=lambda item: item[1], reverse=True)
+    for i, (pl, score) in enumerate(ranked, start=1):
+        lines.append(f" {i}) {render_name(pl)}: _{score}_ kills")
+    return "\n".join(lines)[:2000]
 
 
 def load_mapnames_from_pk3(pk3: Path) -> set[str]:
@@ -47,6 +282,8 @@ def load_mapnames_from_pk3(pk3: Path) -> set[str]:
     Returns:
         Set of all map names found
     """
+    from bspp import bspp  # only needed with extra_maps_dir
+
     try:
         pk = bspp.process_pk3_file(pk3)
     except Exception as ex:
@@ -123,10 +360,42 @@ def generate_map_rotation_cmds(name, rota):
 SUFFIXES = ["bot", ".com", "wtf", "test", "_yep"]
 
 
+class StatsView(discord.ui.View):
+    """Previous/next buttons paging through a StatsPages"""
+
+    def __init__(self, pages, timeout=600):
+        super().__init__(timeout=timeout)
+        self.pages = pages
+        self.number = 0
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.previous.disabled = self.number <= 0
+        self.next.disabled = self.number >= self.pages.page_count - 1
+
+    async def show(self, interaction):
+        self.update_buttons()
+        await interaction.response.edit_message(content=self.pages.page(self.number), view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction, button):
+        self.number -= 1
+        await self.show(interaction)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction, button):
+        self.number += 1
+        await self.show(interaction)
+
+
 class Q3Client(commands.Bot):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.cfg = parse_config()
+        # only needed once the bot is actually running
+        import paho.mqtt.client as mqtt
+        from xrcon.client import XRcon
+
+        self.cfg = get_config()
         self.map_rotations = dict()
         self.map_rotations.update(MAP_ROTATIONS)
         if "extra_maps_dir" in self.cfg:
@@ -156,24 +425,122 @@ class Q3Client(commands.Bot):
         self.game_status_change = False  # if true, we update the presence
         # an attribute we can access from our task
         self.clients = dict()
-        self.msgs = deque()
+        # game control (bots, rotation, status) goes ahead of chat, in its own task
+        self.control_lane = Lane("control")
+        self.chat_lane = None  # once we have Redis, below
 
-        # background task will be created async
+        # background tasks will be created async
         self.bg_task = None
+        self.control_task = None
 
         self.current_game = dict()
 
+        # recent events and finished games, kept in memory for !recent and !lastgame
+        self.recent_events = Ring(int(self.cfg.get("recent_events", "200")))
+        self.last_games = Ring(int(self.cfg.get("recent_games", "10")))
+        self.game_record = None  # the game in progress, until it goes in last_games
+
         self.bot_skill = int(self.cfg.get("bot_skill", 4))
         self.bots_active = False
-        # if set used as second parameter for handle_autobots:
-        self.autobots_change = None
+
+        self.profiler = Profiler(
+            "q3bot-stats",
+            self.cfg.get("profile_dir", "profiles"),
+            int(self.cfg.get("profile_top", "10")),
+            on_finish=self.post_profile,
+        )
+        # live stats, warmed from Redis in setup_hook and then fed every event;
+        # events arriving while warming up are held in stats_pending
+        self.stats = None
+        self.stats_pending = list()
+        self.warm_task = None
+        self.stats_lock = threading.Lock()
+        self.stats_cache = dict()  # since -> (stats version, StatsPages)
+        # stats are computed on worker threads, so they never hold up the event loop
+        self.stats_pool = ThreadPoolExecutor(
+            int(self.cfg.get("stats_workers", "1")), thread_name_prefix="q3stats"
+        )
+        self.stats_queue = int(self.cfg.get("stats_queue", "4"))  # running or waiting
+        self.stats_timeout = float(self.cfg.get("stats_timeout", "15"))
+        self.stats_running = 0  # only touched on the event loop
+        STATS_RUNNING.set_function(lambda: self.stats_running)
+        # with stats_backend=sqlite, finished games also go to an indexed SQLite
+        # store, which then answers the stats queries
+        self.store = None
+        if self.cfg.get("stats_backend", "memory") == "sqlite":
+            self.store = SQLiteStats(self.cfg.get("sqlite_path"))
+        # with stats_backend=api, the q3api service has the stats, and we keep none
+        self.api = None
+        if self.cfg.get("stats_backend", "memory") == "api":
+            self.api = StatsClient(self.cfg.get("stats_url"))
+            self.stats_pending = None
+
+        if "profile_stats" in self.cfg:  # number of !stats calls to profile
+            self.profiler.start(calls=int(self.cfg["profile_stats"]))
         self.add_commands()
 
+        # when the log parser follows several servers, the one we're watching
+        self.server = self.cfg.get("server")
+        self.r = redis_client()  # for the log threads and startup; commands use self.ar
+        self.ar = None
+
+        # chat is bounded: past chat_queue messages it spills to Redis, or drops
+        # chatter, and chatter older than chat_max_age isn't worth sending
+        max_age = float(self.cfg.get("chat_max_age", "120"))
+        spill = self.cfg.get("chat_overflow", "drop") == "spill"
+        self.chat_lane = Lane(
+            "chat",
+            maxsize=int(self.cfg.get("chat_queue", "200")),
+            expires=lambda item: max_age if item[0] == CHATTER else None,
+            r=self.r if spill else None,
+            spill_key=server_key(OUTBOUND_KEY, self.server),
+        )
+        QUEUE_DEPTH.set_function(lambda: len(self.chat_lane))
+
+        # live state survives restarts: restore the last snapshot, and catch up
+        # from the log before listening for new events
+        self.state_lock = threading.Lock()
+        self.last_timestamp = None  # of the last event handled, as logged
+        self.replayed_until = None  # events up to here came from the log already
+        self.status_checked = 0.0
+        self.seeded = False  # by the retained state from q3container
+        self.restored = self.restore_state()
+
         self.mqtt.loop_start()
+        start_server(int(self.cfg.get("bot_metrics_port", "9102")), self.cfg.get("metrics_host", ""))
+
+        # with the stream transport, log events come from Redis rather than MQTT
+        self.stream = None
+        if self.cfg.get("transport", "mqtt") == "stream":
+            self.stream = StreamConsumer(self.r, "q3bot", self.on_stream_entry, server=self.server)
+            threading.Thread(target=self.stream.run, name="q3stream", daemon=True).start()
 
     async def setup_hook(self):
         # create the background task and run it in the background
+        # one pooled async client for the command path, so lookups don't block the loop
+        self.ar = async_redis_client()
         self.bg_task = self.loop.create_task(self.my_background_task())
+        self.control_task = self.loop.create_task(self.run_control())
+        self.loop.create_task(self.snapshot_task())
+        # warm up in the background; !stats says it's loading until then
+        if self.api is None:
+            self.warm_task = self.loop.run_in_executor(None, self.warm_stats)
+
+    async def close(self):
+        if self.ar is not None:
+            await self.save_state()
+            await self.ar.aclose()
+        await super().close()
+
+    async def on_command_error(self, ctx, error):
+        if isinstance(error, StatsBusy):
+            await ctx.channel.send(str(error))
+            return
+        if isinstance(getattr(error, "original", None), redis.RedisError):
+            logger.error(f"Redis failed for {ctx.message.content}: {error.original}")
+            await ctx.channel.send("Stats are unavailable right now, try again later")
+            return
+        await super().on_command_error(ctx, error)
 
     async def on_ready(self):
         logger.info("Logged in as")
@@ -181,11 +548,222 @@ class Q3Client(commands.Bot):
         logger.info(self.user.id)
         logger.info("------")
         await self.change_presence(status=discord.Status.online, activity=self.game)
-        await self.set_map_rotation("default", quiet=True)
+        if not self.restored:  # otherwise the server still has the rotation we set
+            self.control("rotation", self.set_map_rotation, "default", False, True, True)
+
+    @property
+    def state_key(self):
+        return server_key(STATE_KEY, self.server)
+
+    def state_json(self):
+        """The live game state, as saved by save_state; None before any events"""
+        with self.state_lock:
+            if self.last_timestamp is None:
+                return None
+            state = {
+                "clients": self.clients,
+                "current_game": self.current_game,
+                "current_rotation": self.current_rotation,
+                "bots_active": self.bots_active,
+                "last_timestamp": self.last_timestamp,
+                "game_record": self.game_record,
+            }
+            return json.dumps(state)
+
+    async def save_state(self):
+        """Snapshot the live game state to Redis"""
+        state = self.state_json()
+        if state is None:
+            return False  # nothing seen yet, keep any older snapshot
+        await self.ar.set(self.state_key, state)
+        return True
+
+    def restore_state(self):
+        """Load the last snapshot, then replay the events logged after it
+
+        Returns True if there was a snapshot.
+        """
+        try:
+            state = self.r.get(self.state_key)
+        except redis.ConnectionError:
+            logger.exception("Can't restore the live state")
+            return False
+        if state is None:
+            return False
+
+        state = json.loads(state)
+        self.clients = state["clients"]
+        self.current_game = state["current_game"]
+        self.current_rotation = state["current_rotation"]
+        self.bots_active = state["bots_active"]
+        self.last_timestamp = state["last_timestamp"]
+        self.game_record = state.get("game_record")  # not in older snapshots
+        if "mapname" in self.current_game:
+            self.game = discord.Game(f"Quake3E on {self.current_game['mapname']}")
+            self.game_status_change = True
+
+        events = events_since(self.r, self.last_timestamp, self.server)
+        for action, payload in events:
+            self.handle_event(action, payload, replay=True)
+        # MQTT or the stream may deliver some of these again
+        self.replayed_until = self.last_timestamp
+        logger.info(
+            f"Restored state from {state['last_timestamp']}, {len(self.clients)} players online,"
+            f" replayed {len(events)} events"
+        )
+        return True
+
+    async def snapshot_task(self):
+        interval = float(self.cfg.get("state_snapshot_seconds", "30"))
+        while not self.is_closed():
+            await sleep(interval)
+            try:
+                await self.save_state()
+            except redis.RedisError as ex:
+                logger.error(f"Couldn't snapshot the live state: {ex}")
+
+    def warm_stats(self):
+        """load_stats, retrying with backoff until it works"""
+        delay = 1
+        while not self.is_closed():
+            try:
+                self.load_stats()
+                return
+            except Exception as ex:
+                logger.exception(f"Couldn't load the stats, retrying in {delay}s", exc_info=ex)
+            with self.stats_lock:
+                # the log has these by the next try, so don't let them pile up
+                self.stats_pending.clear()
+            time.sleep(delay)
+            delay = min(delay * 2, 300)
+
+    def load_stats(self):
+        """Load the stats from Redis once, then catch up on events seen meanwhile"""
+        sinks = [self.store] if self.store is not None else None
+        stats = Q3LogParse(self.r, sinks=sinks, server=self.server)
+        with STATS_TIME.time(stage="parse_log"):
+            stats.parse_log()
+        if self.store is not None:
+            # catch up on games finished while we were away, and on compacted or
+            # imported games, which are older than the ones the sink stores
+            stored = self.store.load(stats.games)
+            logger.info(f"Stored {stored} new games in {self.store.path}")
+
+        with self.stats_lock:
+            # the log may already hold some of the pending events
+            last = stats.last_timestamp
+            for action, payload in self.stats_pending:
+                if last is None or payload["timestamp"] > last:
+                    stats.handle_event(None, action, payload)
+            self.stats = stats
+            self.stats_pending = None
+        logger.info(f"Stats warmed up with {stats.game_count()} games")
+
+    def feed_stats(self, action, payload):
+        # the parser keeps (and adds to) InitGame payloads, so give it a copy
+        with self.stats_lock:
+            if self.api is not None:
+                return
+            if self.stats is None:
+                self.stats_pending.append((action, dict(payload)))
+            else:
+                self.stats.handle_event(None, action, dict(payload))
+
+    def stats_backend(self):
+        """(version, something to compute stats from without holding stats_lock)
+
+        That's the stats service, the SQLite store, or a snapshot of the live stats;
+        None while warming up. The service keeps its own versions, so it has none.
+        """
+        if self.api is not None:
+            return None, self.api
+        with self.stats_lock:
+            if self.stats is None:
+                return None, None
+            if self.store is not None:
+                return self.stats.version, self.store
+            return self.stats.version, self.stats.snapshot()
+
+    def stats_pages(self, since):
+        """StatsPages since some datetime, reused until another game finishes
+
+        Runs on the stats pool. Returns None if there are no finished games, or the
+        stats aren't loaded yet.
+        """
+        with self.stats_lock:
+            current = self.stats.version if self.stats is not None else None
+            version, pages = self.stats_cache.get(since, (None, None))
+            if version is not None and version == current:
+                return pages
+
+        version, backend = self.stats_backend()
+        if backend is None or backend.first_game() is None:
+            return None
+        with self.profiler.section(), STATS_TIME.time(stage="aggregate"):
+            pages = StatsPages(backend, since)
+
+        with self.stats_lock:  # drop pages from before another game finished
+            self.stats_cache = {k: v for k, v in self.stats_cache.items() if v[0] == version}
+            self.stats_cache[since] = (version, pages)
+        return pages
+
+    def map_leaderboard(self, mapname, since):
+        """Runs on the stats pool; None while warming up"""
+        _, backend = self.stats_backend()
+        if backend is None:
+            return None
+        with STATS_TIME.time(stage="map_leaderboard"):
+            return backend.map_leaderboard(mapname, since)
+
+    async def run_stats(self, func, *args):
+        """Run a stats computation on the stats pool, and wait for the result
+
+        Raises StatsBusy if too many are queued already, or it takes too long.
+        """
+        if self.stats_running >= self.stats_queue:
+            STATS_REFUSED.inc(reason="busy")
+            raise StatsBusy("Busy crunching stats, try again in a bit")
+
+        self.stats_running += 1
+        future = self.loop.run_in_executor(self.stats_pool, func, *args)
+        # only count it done when the worker is, even if we stop waiting
+        future.add_done_callback(self.stats_done)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.stats_timeout)
+        except asyncio.TimeoutError:
+            STATS_REFUSED.inc(reason="timeout")
+            raise StatsBusy("That took too long, try a shorter period") from None
+        except OSError as ex:  # the stats service is down
+            logger.error(f"Stats service failed: {ex}")
+            STATS_REFUSED.inc(reason="unavailable")
+            raise StatsBusy("Stats are unavailable right now, try again later") from None
+
+    def stats_done(self, future):
+        self.stats_running -= 1
+
+    def rcon_execute(self, cmd):
+        command = cmd.split(" ")[0]
+        try:
+            with RCON_TIME.time(command=command):
+                return self.rcon.execute(cmd)
+        except socket.timeout:
+            RCON_TIMEOUTS.inc(command=command)
+            raise
+
+    def rcon_getstatus(self):
+        try:
+            with RCON_TIME.time(command="getstatus"):
+                return self.rcon.getstatus()
+        except socket.timeout:
+            RCON_TIMEOUTS.inc(command="getstatus")
+            raise
 
     async def ensure_status(self, force=False):
-        if "mapname" not in self.current_game or force:
-            status_, players = self.rcon.getstatus()
+        # between games there's no map; don't ask the server on every idle loop
+        refresh = time.monotonic() - self.status_checked > STATUS_REFRESH
+        if ("mapname" not in self.current_game and refresh) or force:
+            self.status_checked = time.monotonic()
+            status_, players = self.rcon_getstatus()
             logger.info(status_)
             status = {k.decode("utf-8"): v.decode("utf-8") for k, v in status_.items()}
             self.current_game.update(status)
@@ -212,14 +790,13 @@ class Q3Client(commands.Bot):
             await self.change_presence(status=discord.Status.online, activity=self.game)
             self.game_status_change = False
 
-        if self.autobots_change is not None:  # stylish ternary logic
-            clicount = len(self.clients)
-            await self.handle_autobots(clicount, self.autobots_change)
-            self.autobots_change = None
+    async def balance_bots(self, joining):
+        """handle_autobots for however many players there are by the time it runs"""
+        await self.handle_autobots(len(self.clients), joining)
 
     async def remove_bots(self):
         logging.info(">>> kick allbots")
-        self.rcon.execute("kick allbots")
+        self.rcon_execute("kick allbots")
 
         # Check that we got rid of them!
         await self.ensure_status(True)
@@ -237,7 +814,7 @@ class Q3Client(commands.Bot):
             # suffix = random.choice(SUFFIXES)
             # botname = f"{bot.capitalize()}{suffix}"
             logging.info(f"Adding {bot}")
-            self.rcon.execute(f"addbot {bot} {self.bot_skill}")
+            self.rcon_execute(f"addbot {bot} {self.bot_skill}")
             added.append(bot)
         await self.ensure_status(True)
         self.bots_active = True
@@ -319,11 +896,129 @@ class Q3Client(commands.Bot):
                 limit: Show stats from 'all', 'week', 'today', yyyy-mm-dd
                        unknown text will be taken as 'all'
             """
-            stats = Q3LogParse()
+            pages = await self.run_stats(self.stats_pages, parse_since(limit))
+            if pages is None:
+                loading = self.stats is None and self.api is None
+                await ctx.channel.send(
+                    "Stats are still loading" if loading else "No games recorded yet"
+                )
+                return
+            # one message, further pages are fetched with its buttons
+            await ctx.channel.send(pages.page(0), view=StatsView(pages))
+
+        @self.command(name="maptop", pass_context=True)
+        async def maptop(ctx, mapname: str, limit: str = "all"):
+            """Show the best players on a map
+
+            Args:
+                mapname: Map name, like q3dm17
+                limit: Count games from 'all', 'week', 'today', yyyy-mm-dd
+            """
             since = parse_since(limit)
-            stats.parse_log()  # TODO: Cache so this can't be used to DOS?
-            for text in stats.stats_text(since):
-                await ctx.channel.send(text)
+            if since is not None and since.tzinfo is None:
+                since = TZ.localize(since)
+            board = await self.run_stats(self.map_leaderboard, mapname, since)
+            if board is None:
+                await ctx.channel.send("Stats are still loading")
+                return
+            await ctx.channel.send(render_leaderboard(mapname, board))
+
+        @self.command(name="player", pass_context=True)
+        async def player(ctx, name: str):
+            """Show one player's stats
+
+            Args:
+                name: Player name (not case sensitive)
+            """
+            name_, data = await PlayerIndex(self.ar, self.server).alookup(name)
+            if name_ is None:
+                await ctx.channel.send(f"No stats recorded for {name}")
+                return
+            await ctx.channel.send(render_player(name_, data))
+
+        @self.command(name="recent", pass_context=True)
+        async def recent(ctx, count: int = 20, kind: str = "all"):
+            """Show the latest events
+
+            Args:
+                count: Number of events to show
+                kind: 'all', or 'kills' for kills only
+            """
+            with self.state_lock:
+                events = self.recent_events.latest()
+            if kind == "kills":
+                events = [event for event in events if event[1] == "Kill"]
+            events = events[: max(1, min(count, 50))]
+            if not any(events):
+                await ctx.channel.send("Nothing has happened yet")
+                return
+            await ctx.channel.send("\n".join(map(render_event, reversed(events)))[:2000])
+
+        @self.command(name="lastgame", pass_context=True)
+        async def lastgame(ctx, number: int = 1):
+            """Show the scores of a recent game
+
+            Args:
+                number: 1 for the last game, 2 for the one before, etc.
+            """
+            with self.state_lock:
+                games = self.last_games.latest(number)
+            if len(games) < max(number, 1):
+                await ctx.channel.send(f"Only {len(games)} recent games to show")
+                return
+            await ctx.channel.send(render_scoreboard(games[number - 1]))
+
+        @self.command(name="ladder", pass_context=True)
+        async def ladder(ctx, count: int = 10):
+            """Show the skill rating ladder
+
+            Args:
+                count: Number of players to show
+            """
+            await ctx.channel.send(
+                render_ladder(
+                    await RatingIndex(self.ar, self.server).aladder(max(1, min(count, 30)))
+                )
+            )
+
+        @self.command(name="vs", pass_context=True)
+        async def versus(ctx, player: str, target: str):
+            """Show head-to-head kills between two players
+
+            Args:
+                player: Player name (not case sensitive)
+                target: The other player
+            """
+            index = PlayerIndex(self.ar, self.server)
+            player_ = await index.acanonical_name(player)
+            target_ = await index.acanonical_name(target)
+            for name, found in ((player, player_), (target, target_)):
+                if found is None:
+                    await ctx.channel.send(f"No stats recorded for {name}")
+                    return
+            kills, deaths = await VersusIndex(self.ar, self.server).alookup(player_, target_)
+            await ctx.channel.send(render_versus(player_, target_, kills, deaths))
+
+        @self.command(name="profile", pass_context=True)
+        async def profile(ctx, target: str = "stats", amount: int = 0):
+            """Profile !stats or the log parser (admins only)
+
+            Args:
+                target: 'stats' to profile the next !stats calls,
+                        'container' to profile the log parser
+                amount: Number of !stats calls (default 5), or seconds (default 60)
+            """
+            if str(ctx.author.id) not in self.cfg.get("admin_ids", "").split(","):
+                await ctx.channel.send("profiling is restricted to admins")
+                return
+
+            if target == "container":
+                self.mqtt.publish("q3bot/profile", str(amount or 60), qos=1)
+                await ctx.channel.send(f"Profiling the log parser for {amount or 60}s")
+            elif self.profiler.start(calls=amount or 5):
+                await ctx.channel.send(f"Profiling the next {amount or 5} !stats calls")
+            else:
+                await ctx.channel.send("Already profiling !stats")
 
         @self.command(name="newgame", pass_context=True)
         async def newgame(ctx, playmap: str = "RANDOM_MAP"):
@@ -352,7 +1047,7 @@ class Q3Client(commands.Bot):
                 if playmap in self.map_rotations[mr]:
                     await ctx.channel.send(f"Heading to {playmap}")
                     await self.set_map_rotation(mr, changemap=False, randomize=True)
-                    self.rcon.execute(f"map {playmap}")
+                    self.rcon_execute(f"map {playmap}")
                     await self.ensure_status(True)
                     found_map = True
 
@@ -366,8 +1061,8 @@ class Q3Client(commands.Bot):
         # self.add_command(status)
         # self.add_command(maps)
 
-    def on_mqtt_log(client, userdata, level, buff):
-        console.debug(buff)
+    def on_mqtt_log(self, client, userdata, level, buff):
+        logger.debug(buff)
 
     def on_mqtt_connect(self, client, userdata, flags, rc, props):
         logger.info("Connected with result code " + str(rc))
@@ -382,7 +1077,16 @@ class Q3Client(commands.Bot):
             logger.info("q3client", msg.topic + " " + str(msg.payload))
             return True
 
-        if tokens[1] != "log":
+        if tokens[1] == "profile":  # summary from the log parser profiler
+            self.post_profile(msg.payload.decode("utf-8"))
+            return True
+
+        if self.server is not None:  # q3server/<server>/log/...
+            if tokens[1] != self.server:
+                return True
+            tokens = tokens[:1] + tokens[2:]
+
+        if tokens[1] not in ("log", "state"):
             return True
 
         payload = msg.payload.decode("utf-8")
@@ -395,34 +1099,115 @@ class Q3Client(commands.Bot):
         logstr = f"{msg.topic} {payload}"
         logger.info(logstr)
 
+        if tokens[1] == "state":
+            return self.seed_state(payload)
+        return self.handle_event(tokens[2], payload)
+
+    def seed_state(self, state):
+        """Use the live state q3container publishes, instead of asking over rcon
+
+        It's retained, so we get it on connect: if it's ahead of our snapshot (or
+        we had none), we take all of it. After that we follow the events ourselves,
+        and only take the map from it when we don't know it.
+        """
+        with self.state_lock:
+            ahead = self.last_timestamp is None or state["timestamp"] > self.last_timestamp
+            changed = True
+            if not self.seeded and ahead:
+                self.current_game = state["game"]
+                self.clients = state["clients"]
+                self.last_timestamp = state["timestamp"]
+                # the events it was built from may still reach us from the stream
+                self.replayed_until = state["timestamp"]
+                logger.info(
+                    f"Seeded state from {state['timestamp']}, {len(self.clients)} players online"
+                )
+            elif "mapname" not in self.current_game and "mapname" in state["game"]:
+                self.current_game.update(state["game"])
+            else:
+                changed = False
+            self.seeded = True
+            if changed and "mapname" in self.current_game:
+                self.game = discord.Game(f"Quake3E on {self.current_game['mapname']}")
+                self.game_status_change = True
+        return True
+
+    def say(self, msg, kind=CHATTER):
+        """Queue a message for the Discord channel; chatter is dropped when stale"""
+        self.chat_lane.put((kind, msg))
+
+    def control(self, name, func, *args):
+        """Queue a game control action, await func(*args), ahead of any chat"""
+        self.control_lane.put((name, func, args))
+
+    def post_profile(self, summary):
+        self.say(f"```\n{summary[:1900]}\n```", RESULT)
+
+    def on_stream_entry(self, pipe, entry_id, fields):
+        obj = json.loads(entry_object(fields))
+        payload = json.loads(obj["content"])
+        logger.info(f"{entry_id} {payload}")
+
+        self.handle_event(obj["action"], payload)
+
+    def handle_event(self, action, payload, replay=False):
+        """Handle one log event, from MQTT or the log stream
+
+        Replayed events (from the log, after a restart) update the state quietly.
+        """
+        with self.state_lock:
+            if self.replayed_until is not None:
+                if payload["timestamp"] <= self.replayed_until:
+                    return True
+                self.replayed_until = None
+            if not replay:
+                EVENTS.inc(action=action)
+                self.feed_stats(action, payload)
+            self.last_timestamp = payload["timestamp"]
+            say = self.say if not replay else (lambda msg, kind=CHATTER: None)
+            return self.apply_event(action, payload, say)
+
+    def apply_event(self, action, payload, say):
+        """Update the live state from one event, passing any messages to say"""
         ts = parse(payload["timestamp"]).astimezone(TZ)
         # This is the action!
-        if tokens[2] == "ShutdownGame":
+        if action == "ShutdownGame":
+            # the end of a game is one message, with everything buffered since Exit
+            if self.game_record is not None and any(self.game_record["scores"]):
+                say(render_scoreboard(self.game_record), RESULT)
+                self.last_games.append(self.game_record)
+            self.game_record = None
             self.clients = dict()
             self.current_game = dict()
+            # the next InitGame is seconds away, no need to ask the server for the map
+            self.status_checked = time.monotonic()
             logger.info(f"Server restarting at {ts:%Y-%m-%d %H:%M}!")
-        elif tokens[2] == "InitGame":
+        elif action == "InitGame":
             if any(self.clients):  # Only if players are connected
-                self.msgs.append(
-                    f"New game starting on {payload['mapname']} at {ts:%Y-%m-%d %H:%M}!"
-                )
+                say(f"New game starting on {payload['mapname']} at {ts:%Y-%m-%d %H:%M}!")
             self.current_game.update(payload)
             self.current_game["fraglimit"] = int(self.current_game.get("fraglimit", 100))
             self.game = discord.Game(f"Quake3E on {payload['mapname']}")
             self.game_status_change = True
+            self.game_record = new_game_record(payload["mapname"], payload["timestamp"])
+            self.recent_events.append((payload["timestamp"], "InitGame", payload["mapname"]))
 
             self.clients = dict()
-        elif tokens[2] == "Exit":
-            if any(self.clients):  # Only if players are connected
-                self.msgs.append(
-                    f"Game ended due to {payload['reason'].lower()[:-1]} at {ts:%Y-%m-%d %H:%M}"
-                )
-            self.current_game = dict()
-        elif tokens[2] == "Score":
-            self.msgs.append(f" > {payload['n']}: {payload['score']} kills")
-        elif tokens[2] == "Kill":
+        elif action == "Exit":
+            reason = payload["reason"].lower()[:-1]
+            if self.game_record is None:  # we missed the start, but can still report the end
+                mapname = self.current_game.get("mapname", "<unknown map>")
+                self.game_record = new_game_record(mapname, None)
+            self.game_record["ended"] = payload["timestamp"]
+            self.game_record["reason"] = reason
+            # still on the map until ShutdownGame, which clears the game
+            self.recent_events.append((payload["timestamp"], "Exit", reason))
+        elif action == "Score":
+            if self.game_record is not None:
+                self.game_record["scores"][payload["n"]] = payload["score"]
+        elif action == "Kill":
             if payload["method"] == "MOD_LIGHTNING":
-                self.msgs.append(
+                say(
                     f"{render_name(payload['n'])} killed "
                     f"{render_name(payload['targetn'])} "
                     f"with {self.cfg.get('lightning_injoke', 'the power of Zeus')}"
@@ -435,6 +1220,17 @@ class Q3Client(commands.Bot):
                 clidx = payload["clientid"]
                 name_ = payload["n"]
 
+            weapon = MOD_TO_WEAPON.get(int(payload["methodid"]), "unknown")
+            killer = name_ if payload["clientid"] != IX_WORLD else None
+            self.recent_events.append(
+                (payload["timestamp"], "Kill", killer, payload["targetn"], weapon)
+            )
+            if self.game_record is not None and killer not in (None, payload["targetn"]):
+                kills = self.game_record.setdefault("kills", dict())  # not in older snapshots
+                kills[killer] = kills.get(killer, 0) + 1
+                weapons = self.game_record.setdefault("weapons", dict())
+                weapons[weapon] = weapons.get(weapon, 0) + 1
+
             # grab names while we have the chance
             self.clients.setdefault(payload["targetid"], dict()).setdefault("n", payload["targetn"])
 
@@ -448,24 +1244,24 @@ class Q3Client(commands.Bot):
                 cli["running_score"] += 1
                 if cli["running_score"] > 0 and (cli["running_score"] % 5) == 0:
                     if "n" in cli:
-                        self.msgs.append(f"{cli['n']} has {cli['running_score']} kills")
+                        say(f"{cli['n']} has {cli['running_score']} kills")
                 delta = cli["running_score"] - int(self.current_game.get("fraglimit", 100))
                 style = random.choice(STYLE_EMOJI)
                 if delta == -3 and "threefrags" not in self.current_game:
-                    self.msgs.append(f"THREE FRAGS LEFT {style * 3}")
+                    say(f"THREE FRAGS LEFT {style * 3}")
                     self.current_game["threefrags"] = True
                 elif delta == -2 and "twofrags" not in self.current_game:
-                    self.msgs.append(f"TWO FRAGS LEFT {style * 2}")
+                    say(f"TWO FRAGS LEFT {style * 2}")
                     self.current_game["twofrags"] = True
                 elif delta == -1 and "onefrag" not in self.current_game:
-                    self.msgs.append(f"ONE FRAG LEFT {style}")
+                    say(f"ONE FRAG LEFT {style}")
                     self.current_game["onefrag"] = True
-        elif tokens[2] == "Client":
+        elif action == "Client":
             clidx = payload["clientid"]
             if not any(self.clients):
                 # New game!
                 map = self.current_game.get("mapname", "<unknown map>")
-                self.msgs.append(
+                say(
                     f"Q3E server {self.cfg['servername']}: "
                     f"New game starting on {map} "
                     f"at {ts:%Y-%m-%d %H:%M}!"
@@ -478,20 +1274,22 @@ class Q3Client(commands.Bot):
                 clicount = len(self.clients)
                 serverstate = f"{clicount} players online" if clicount > 0 else "server empty"
 
-                self.autobots_change = False
-                self.msgs.append(f"{render_name(cli.get('n'))} disconnected, {serverstate}")
+                self.control("autobots", self.balance_bots, False)
+                self.recent_events.append((payload["timestamp"], "Disconnect", cli.get("n")))
+                say(f"{render_name(cli.get('n'))} disconnected, {serverstate}")
             elif payload["action"] == "Begin":
                 pass  # we trigger on receiving the name instead
             elif payload["action"] == "Connect":
                 pass
             elif payload["action"] == "InfoChanged":
                 if prev_name is not None and prev_name != cli["n"]:
-                    self.msgs.append(f"{prev_name} changed name to {render_name(cli.get('n'))}")
+                    say(f"{prev_name} changed name to {render_name(cli.get('n'))}")
             if prev_name is None and "n" in payload:
                 clicount = len(self.clients)
                 serverstate = f"{clicount} players online" if clicount > 0 else "server empty"
-                self.autobots_change = True
-                self.msgs.append(f"{render_name(cli.get('n'))} joined the game, {serverstate}")
+                self.control("autobots", self.balance_bots, True)
+                self.recent_events.append((payload["timestamp"], "Join", cli.get("n")))
+                say(f"{render_name(cli.get('n'))} joined the game, {serverstate}")
 
         return True
 
@@ -530,47 +1328,51 @@ class Q3Client(commands.Bot):
         if not quiet:
             await channel.send(f"> {', '.join(rota)}")
         for item in items:
-            self.rcon.execute(item)
+            self.rcon_execute(item)
 
         if not changemap:
             immediate = f"set nextmap {immediate}"
-            self.rcon.execute(immediate)
+            self.rcon_execute(immediate)
             if not quiet:
                 await channel.send(f"Next map set to {rota[0]}")
-            self.rcon.execute(f"say Map rotation changed to {rotaname}, next map is {rota[0]}")
+            self.rcon_execute(f"say Map rotation changed to {rotaname}, next map is {rota[0]}")
         else:
             await channel.send(f"Immediately changing to {rota[0]}")
-            self.rcon.execute(immediate)
+            self.rcon_execute(immediate)
         self.current_rotation = rotaname
 
     async def my_background_task(self):
         await self.wait_until_ready()
         channel = self.get_channel(int(self.cfg["channel"]))
 
-        while not self.is_closed():
-            msg = None
+        async def send(item):
+            _, msg = item
             try:
-                msg = self.msgs.popleft()
-            except IndexError:
-                await sleep(0.01)  # tiny sleep to avoid spamming CPU
-
-            if msg is not None:
-                await channel.send(msg)
-            else:
-                await self.ensure_status()
+                with SEND_TIME.time():
+                    await channel.send(msg)
+            except (discord.DiscordServerError, aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                # Discord is down or unreachable: keep the message, and it'll be stale
+                # if it's chatter
+                logger.error(f"Discord send failed ({ex}), retrying")
+                raise Retry() from ex
+
+        await self.chat_lane.run(send, until=self.is_closed)
+
+    async def run_control(self):
+        """Game control actions as they're queued, and the status refresh in between"""
+        await self.wait_until_ready()
 
+        async def act(item):
+            name, func, args = item
+            logger.info(f"control> {name}")
+            await func(*args)
 
-def parse_config():
-    cfg = dict()
-    with open("secrets.ini", "rt") as f:
-        for line in f.readlines():
-            k, v = line.strip().split("=")
-            cfg[k] = v
-    return cfg
+        await self.control_lane.run(act, idle=self.ensure_status, until=self.is_closed)
 
 
 def main():
-    cfg = parse_config()
+    setup_logging("discord.log")
+    cfg = get_config()
     intents = discord.Intents.default()
     intents.typing = False
     intents.presences = False
@@ -0,0 +1,161 @@
+"""Retention for the raw q3log list
+
+Finished games older than a cutoff are folded into compact per-game records in
+the q3games hash, and the raw lines they came from are trimmed off q3log.
+Q3LogParse.parse_log reads both, so stats come out the same either way; run with
+--verify to check that against the live data without writing anything.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import logging
+import sys
+
+from q3constants import CONFIG, TZ, redis_client, server_key
+from q3parselog import (
+    COMPACT_KEY,
+    LOG_KEY,
+    TRIMMED_KEY,
+    Q3LogParse,
+    game_from_record,
+    game_to_record,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def find_cut(parsed, trimmed, length, cutoff):
+    """Find the raw list index before which all lines belong to compactable games
+
+    Cuts at the first game started after the cutoff, and never beyond the start of
+    a game still in progress.
+    """
+    cut = length
+    for ts, offset in parsed.game_offsets.items():
+        if ts >= cutoff:
+            cut = min(cut, offset - trimmed)
+    if parsed.last_start is not None:
+        cut = min(cut, parsed.game_offsets[parsed.last_start] - trimmed)
+
+    return cut
+
+
+def build_view(r, records, lines, trimmed):
+    """Build the stats view of some compacted records plus raw lines"""
+    parsed = Q3LogParse(r)
+    parsed.load_compacted(records)
+    parsed.parse_lines(lines, trimmed)
+    parsed.drop_orphans()
+    return parsed
+
+
+def compare_views(before, after, cutoff):
+    """Check that two views give identical stats; returns a list of differences"""
+    problems = list()
+    if before.games.keys() != after.games.keys():
+        missing = len(before.games.keys() - after.games.keys())
+        extra = len(after.games.keys() - before.games.keys())
+        problems.append(f"{missing} games missing, {extra} extra games")
+    else:
+        for ts, game in before.games.items():
+            if after.games[ts] != game:
+                problems.append(f"game {ts:%Y-%m-%d %H:%M} differs")
+
+    for since in (None, cutoff):
+        if before.player_meta(since) != after.player_meta(since):
+            problems.append(f"player stats differ (since {since})")
+        if before.first_game() is None:  # no finished games, so no stats text
+            continue
+        if list(before.stats_text(since)) != list(after.stats_text(since)):
+            problems.append(f"stats text differs (since {since})")
+
+    return problems
+
+
+def compact(r, max_age, verify=False, server=None):
+    """Fold finished games older than max_age out of the raw log
+
+    Args:
+        r: Redis client
+        max_age: timedelta; games that started before now - max_age are compacted
+        verify: Only compare stats before/after compaction, don't write anything
+        server: Game server name, when following several
+
+    Returns:
+        (games compacted, lines trimmed, list of problems found by verification)
+    """
+    cutoff = datetime.now(TZ) - max_age
+    log_key = server_key(LOG_KEY, server)
+    compact_key = server_key(COMPACT_KEY, server)
+    trimmed_key = server_key(TRIMMED_KEY, server)
+    with r.pipeline() as pipe:
+        # a concurrent compaction changes the trimmed count, and will abort this one
+        pipe.watch(trimmed_key)
+        records = pipe.hgetall(compact_key)
+        trimmed = int(pipe.get(trimmed_key) or 0)
+        lines = pipe.lrange(log_key, 0, -1)
+
+        before = build_view(r, records, lines, trimmed)
+        cut = find_cut(before, trimmed, len(lines), cutoff)
+
+        new_records = {
+            ts.isoformat(): game_to_record(game)
+            for ts, game in before.games.items()
+            if ts in before.game_offsets and before.game_offsets[ts] - trimmed < cut
+        }
+        logger.info(f"{len(new_records)} games to compact, trimming {cut} of {len(lines)} lines")
+
+        problems = list()
+        if verify:
+            after = build_view(r, records | new_records, lines[cut:], trimmed + cut)
+            problems = compare_views(before, after, cutoff)
+            # and make sure the records survive the round trip
+            for key, rec in new_records.items():
+                if game_from_record(rec) != before.games[datetime.fromisoformat(key)]:
+                    problems.append(f"record {key} doesn't round-trip")
+            pipe.unwatch()
+            return len(new_records), cut, problems
+
+        pipe.multi()
+        if any(new_records):
+            pipe.hset(compact_key, mapping=new_records)
+        if cut > 0:
+            pipe.ltrim(log_key, cut, -1)
+            pipe.incrby(trimmed_key, cut)
+        pipe.execute()
+
+    return len(new_records), cut, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact old games out of the raw q3log")
+    parser.add_argument(
+        "--days",
+        type=float,
+        default=float(CONFIG.get("compact_age_days", "30")),
+        help="compact finished games older than this many days",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="check that compaction leaves the stats unchanged, without writing",
+    )
+    parser.add_argument("--server", help="game server name, when following several")
+    args = parser.parse_args()
+
+    r = redis_client()
+
+    games, lines, problems = compact(r, timedelta(days=args.days), args.verify, args.server)
+    verb = "Would compact" if args.verify else "Compacted"
+    print(f"{verb} {games} games, trimming {lines} raw log lines")
+
+    for problem in problems:
+        print(f"MISMATCH: {problem}")
+    if args.verify:
+        print("Verification failed" if any(problems) else "Verified: stats are identical")
+
+    return 1 if any(problems) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,16 @@
+from collections.abc import Mapping
 from datetime import datetime, timedelta
+import functools
+import json
+import logging
+import threading
 from typing import Optional
 
 from dateutil.parser import parse
 import pytz
 
+logger = logging.getLogger(__name__)
+
 TZ = pytz.timezone("Europe/Oslo")
 IX_WORLD = "1022"
 STYLE_EMOJI = ["👻", "💀", "☠️", "😵", "🤯", "🤬", "🤘", "🎯", "💣", "🍖"]
@@ -114,18 +121,160 @@ def is_bot(name):
     return name.lower() in BOTS
 
 
-def parse_config():
+def parse_config(path="secrets.ini"):
+    """Read key=value lines, skipping blank lines and ;comments"""
     cfg = dict()
-    with open("secrets.ini", "rt") as f:
+    with open(path, "rt") as f:
         for line in f.readlines():
-            if line[0] == ";":
+            line = line.strip()
+            if not line or line[0] == ";":
                 continue
-            k, v = line.strip().split("=")
+            k, v = line.split("=", 1)
             cfg[k] = v
     return cfg
 
 
-CONFIG = parse_config()
+@functools.lru_cache(maxsize=None)
+def get_config():
+    """The config, read on first use; without secrets.ini, everything is a default"""
+    try:
+        return parse_config()
+    except FileNotFoundError:
+        logger.warning("No secrets.ini, using defaults")
+        return dict()
+
+
+class LazyConfig(Mapping):
+    """Read-only view of get_config(), so importing doesn't read secrets.ini"""
+
+    def __getitem__(self, key):
+        return get_config()[key]
+
+    def __iter__(self):
+        return iter(get_config())
+
+    def __len__(self):
+        return len(get_config())
+
+
+CONFIG = LazyConfig()
+
+
+@functools.lru_cache(maxsize=None)
+def redis_client():
+    """Redis client from the config, shared and created on first use"""
+    import redis
+
+    return redis.Redis(
+        host=CONFIG.get("redishost", "q3redis"),
+        port=int(CONFIG.get("redisport", "6379")),
+        db=int(CONFIG.get("redisdb", "0")),
+    )
+
+
+def async_redis_client():
+    """redis.asyncio client from the config, on a bounded pool with timeouts
+
+    Connections belong to the event loop they're made in, so create it in there.
+    """
+    import redis.asyncio
+
+    timeout = float(CONFIG.get("redis_timeout", "2"))
+    pool = redis.asyncio.BlockingConnectionPool(
+        host=CONFIG.get("redishost", "q3redis"),
+        port=int(CONFIG.get("redisport", "6379")),
+        db=int(CONFIG.get("redisdb", "0")),
+        max_connections=int(CONFIG.get("redis_pool_size", "10")),
+        timeout=timeout,  # waiting for a free connection
+        socket_timeout=timeout,
+        socket_connect_timeout=timeout,
+    )
+    return redis.asyncio.Redis(connection_pool=pool)
+
+
+class SpillList(object):
+    """Redis list a bounded in-memory queue overflows to
+
+    Once anything has spilled, everything goes to the list until the consumer has
+    drained it, so items stay in order. The queue's producer checks spilling and
+    pushes while holding lock, which pop also holds to stop spilling, so nothing is
+    pushed just after the list was found drained.
+    """
+
+    def __init__(self, r, key, name, lock=None):
+        """
+        Args:
+            r: Redis client
+            key: Redis list to spill to
+            name: The queue's name, for logs
+            lock: The queue's lock, default a new one
+        """
+        self.r = r
+        self.key = key
+        self.name = name
+        self.lock = lock or threading.Lock()
+        # left over from before a restart
+        self.spilling = r.llen(key) > 0
+
+    def __len__(self):
+        return self.r.llen(self.key)
+
+    def push(self, item):
+        """Append a JSON-able item; the caller holds lock"""
+        self.r.rpush(self.key, json.dumps(item))
+        if not self.spilling:
+            logger.error(f"{self.name} full, spilling to Redis")
+            self.spilling = True
+
+    def pop(self, count):
+        """Up to count spilled items, oldest first; call once the queue is empty"""
+        spilled = self.r.lpop(self.key, count)
+        if spilled:
+            return [json.loads(item) for item in spilled]
+        with self.lock:
+            if self.r.llen(self.key) == 0:
+                logger.info(f"{self.name} spill list drained")
+                self.spilling = False
+        return list()
+
+
+def setup_logging(filename):
+    """Errors to a log file, everything to the console; for main(), not on import"""
+    logging.basicConfig(
+        filename=filename,
+        level=logging.ERROR,
+        format="[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s",
+        datefmt="%H:%M:%S",
+    )
+    # set up logging to console
+    console = logging.StreamHandler()
+    console.setLevel(logging.DEBUG)
+    # set a format which is simpler for console use
+    formatter = logging.Formatter("[%(asctime)s] %(name)-12s: %(levelname)-8s %(message)s")
+    console.setFormatter(formatter)
+    # add the handler to the root logger
+    logging.getLogger("").addHandler(console)
+
+
+def server_key(key, server=None):
+    """Redis key for one game server; server None is the single-server layout"""
+    return key if server is None else f"{server}:{key}"
+
+
+def server_topic(topic, server=None):
+    """MQTT topic for one game server, e.g. q3server/<server>/log/Kill"""
+    return f"q3server/{topic}" if server is None else f"q3server/{server}/{topic}"
+
+
+def parse_servers(spec):
+    """Parse "name:container,container2" into {name: container}"""
+    servers = dict()
+    for item in spec.split(","):
+        if len(item.strip()) == 0:
+            continue
+        name, _, container = item.strip().rpartition(":")
+        servers[name or container] = container
+    return servers
 
 
 def parse_since(sincestr: str) -> Optional[datetime]:
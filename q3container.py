@@ -1,52 +1,76 @@
+from contextlib import nullcontext
 from io import BytesIO
 import json
 import logging
-
-import docker
-import paho.mqtt.client as mqtt
-import redis
-
-from q3constants import CONFIG
-
-logging.basicConfig(
-    filename="mqtt.log",
-    level=logging.ERROR,
-    format="[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s",
-    datefmt="%H:%M:%S",
+import queue
+import threading
+
+from q3constants import (
+    CONFIG,
+    IX_WORLD,
+    SpillList,
+    parse_servers,
+    redis_client,
+    server_key,
+    server_topic,
+    setup_logging,
 )
-# set up logging to console
-console = logging.StreamHandler()
-console.setLevel(logging.DEBUG)
-# set a format which is simpler for console use
-formatter = logging.Formatter("[%(asctime)s] %(name)-12s: %(levelname)-8s %(message)s")
-console.setFormatter(formatter)
-# add the handler to the root logger
-logging.getLogger("").addHandler(console)
+from q3index import Indexer, all_indexes
+from q3metrics import Counter, Gauge, Histogram, start_server
+from q3parselog import LOG_KEY
+from q3profile import Profiler
+from q3stream import STREAM_KEY, stream_fields, stream_maxlen
 
 logger = logging.getLogger(__name__)
 
 
-MQTTSERVER = CONFIG.get("mqtt", "q3mosquitto")
-DCK = docker.from_env()
+DCK = None  # connected on first use, so the parsing here works without docker
 SHUTDOWN = False
+PROFILER = None  # set up in main
 
+LINES_READ = Counter("q3container_lines_read_total", "Log lines read from the container")
+LINES_PARSED = Counter("q3container_lines_parsed_total", "Log lines parsed to events", ["action"])
+LINES_DROPPED = Counter("q3container_lines_dropped_total", "Log lines not sent on", ["action"])
+PARSE_TIME = Histogram("q3container_parse_seconds", "Time spent in parse_line")
+REDIS_TIME = Histogram("q3container_redis_seconds", "Redis write latency", ["command"])
+MQTT_TIME = Histogram("q3container_mqtt_publish_seconds", "MQTT publish latency (QoS 2)")
+QUEUE_DEPTH = Gauge("q3container_queue_depth", "Items waiting between pipeline stages", ["stage"])
+SPILLED = Counter("q3container_spilled_lines_total", "Lines spilled to Redis on a full queue")
+STATES_PUBLISHED = Counter("q3container_states_published_total", "Live state snapshots published")
 
-def log_handler(all_lines=False):
-    """Attach to container, and follow all incoming log lines
-    - we might get these as single bytes"""
-    q3 = DCK.containers.get("q3server")
-    logger.info(f"Following container {q3}")
+SPILL_KEY = "q3spill"
 
-    line = BytesIO()
-    last_r = False
-    emit_line = False
+
+def docker_client():
+    global DCK
+    if DCK is None:
+        import docker
+
+        DCK = docker.from_env()
+    return DCK
+
+
+def log_handler(container="q3server", all_lines=False):
+    """Attach to container, and follow all incoming log lines"""
+    q3 = docker_client().containers.get(container)
+    logger.info(f"Following container {q3}")
 
     extra_kwargs = dict(follow=False)
     if not all_lines:
         extra_kwargs["tail"] = 0
         extra_kwargs["follow"] = True
 
-    for ch in q3.logs(stream=True, timestamps=True, **extra_kwargs):
+    yield from assemble_lines(q3.logs(stream=True, timestamps=True, **extra_kwargs))
+
+
+def assemble_lines(chunks):
+    """Lines from docker log chunks
+    - we might get these as single bytes"""
+    line = BytesIO()
+    last_r = False
+    emit_line = False
+
+    for ch in chunks:
         if len(ch) > 1:
             # assume full line
             yield ch
@@ -69,18 +93,85 @@ def log_handler(all_lines=False):
                 line = BytesIO()
 
 
-def handle_log():
+def handle_log(container="q3server"):
     """Attach to container, and follow all incoming log lines"""
-    for line in log_handler():
+    for line in log_handler(container):
         yield line.decode("utf-8").strip()
 
 
-def handle_log_all():
+def handle_log_all(container="q3server"):
     """Replay entire log, then stop following"""
-    for line in log_handler(True):
+    for line in log_handler(container, True):
         yield line.decode("utf-8").strip()
 
 
+class StageQueue(object):
+    """Bounded queue between two pipeline stages
+
+    When full, put() either blocks (overflow "block"), or with a Redis client
+    (overflow "spill") appends to a Redis list instead, so the producer never
+    waits. Once anything has spilled, everything goes to the list until the
+    consumer has drained it, so items stay in order.
+    """
+
+    def __init__(self, name, maxsize, r=None, spill_key=SPILL_KEY):
+        self.name = name
+        self.q = queue.Queue(maxsize)
+        self.spill = None
+        QUEUE_DEPTH.set_function(self.q.qsize, stage=name)
+        if r is not None:
+            self.spill = SpillList(r, spill_key, f"{name} queue")
+            QUEUE_DEPTH.set_function(self.spill.__len__, stage=f"{name}_spilled")
+
+    @property
+    def spilling(self):
+        return self.spill is not None and self.spill.spilling
+
+    def put(self, item):
+        if self.spill is None:
+            self.q.put(item)
+            return
+
+        with self.spill.lock:
+            if not self.spill.spilling:
+                try:
+                    self.q.put_nowait(item)
+                    return
+                except queue.Full:
+                    pass
+            self.spill.push(item)
+            SPILLED.inc()
+
+    def get_batch(self, size, timeout=1):
+        """Up to size items, waiting up to timeout seconds for the first"""
+        batch = list()
+        try:
+            # while spilling, don't wait: the next items may be in the spill list
+            batch.append(self.q.get(timeout=timeout if not self.spilling else 0))
+        except queue.Empty:
+            pass
+        while len(batch) < size:
+            try:
+                batch.append(self.q.get_nowait())
+            except queue.Empty:
+                break
+
+        if len(batch) == 0 and self.spilling:
+            # the queue is empty, and everything in it predates the spill list
+            batch = [tuple(item) for item in self.spill.pop(size)]
+        return batch
+
+
+def follow(server, container, lines):
+    """Follow one container's log into the shared queue, as (server, line)"""
+    try:
+        for line in handle_log(container):
+            lines.put((server, line))
+    except Exception as ex:
+        logger.exception(f"Lost container {container}", exc_info=ex)
+    lines.put((server, None))  # the log ended (or failed), so the writer stops
+
+
 def parse_combined_line(line):
     line = " ".join(line)
     skip = 1 if line[0] == "\\" else 0
@@ -177,6 +268,14 @@ def parse_line(line):
     return buildobj
 
 
+def line_action(line):
+    """Cheap guess at the action of a line parse_line dropped, for metrics"""
+    tokens = line.split(" ", 2)
+    if len(tokens) < 2 or tokens[1][-1:] != ":":
+        return "info"
+    return tokens[1][:-1]
+
+
 def redis_line(buildobj):
     if isinstance(buildobj["content"], bytes):
         buildobj["content"] = buildobj["content"].decode("utf-8")
@@ -198,47 +297,243 @@ def on_message(client, userdata, msg):
     if tokens[1] == "shutdown":
         logger.info("Got shutdown signal")
         SHUTDOWN = True
+    elif tokens[1] == "profile":  # payload is the number of seconds to profile for
+        PROFILER.start(seconds=float(msg.payload or 60))
     else:
         logger.info("q3bot", msg.topic + " " + str(msg.payload))
 
 
 def on_log(client, userdata, level, buff):
-    console.debug(buff)
+    logger.debug(buff)
+
+
+def parse(line):
+    """parse_line, with metrics"""
+    LINES_READ.inc()
+    with PARSE_TIME.time():
+        obj = parse_line(line)
+    if obj is None:
+        LINES_DROPPED.inc(action=line_action(line))
+        return None
+    if "content" not in obj:
+        logger.error(f"No content in {obj}")
+        return None
+    LINES_PARSED.inc(action=obj["action"])
+    return obj
+
+
+class Writer(object):
+    """Writes parsed lines from all followed servers to MQTT/Redis, in pipelined batches"""
+
+    def __init__(self, src, r, transport, servers, index=True):
+        """
+        Args:
+            src: MQTT client
+            r: Redis client
+            transport: "mqtt" publishes to MQTT and q3log, "stream" only adds to the q3stream
+            servers: Names of the servers followed; [None] for the single-server layout
+            index: Update the q3index indexes as games finish (with the mqtt transport)
+        """
+        self.src = src
+        self.r = r
+        self.transport = transport
+        self.maxlen = stream_maxlen()
+        self.states = {server: LiveState() for server in servers}
+        # with the stream transport, q3stream does the indexing
+        self.indexers = dict()
+        if index and transport != "stream":
+            for server in servers:
+                self.indexers[server] = Indexer(r, all_indexes(r, server))
+                self.indexers[server].resume(server)
+
+    def write(self, batch):
+        """Write a list of (server, parsed line)"""
+        pipe = self.r.pipeline(transaction=False)
+        published = list()
+        robjs = list()
+        changed = set()
+        for server, obj in batch:
+            logger.info(f"Publishing {obj}")
+            if self.states[server].feed(obj["action"], json.loads(obj["content"])):
+                changed.add(server)
+            if self.transport != "stream":
+                path = server_topic(f"log/{obj['action']}", server)
+                if "clientid" in obj:
+                    path += f"/{obj['clientid']}"
+                published.append(self.src.publish(path, obj["content"], qos=2))
+
+            robj = redis_line(obj)
+            robjs.append((server, robj))
+            if self.transport == "stream":
+                pipe.xadd(
+                    server_key(STREAM_KEY, server),
+                    stream_fields(obj, robj),
+                    maxlen=self.maxlen,
+                    approximate=True,
+                )
+            else:
+                pipe.rpush(server_key(LOG_KEY, server), robj)
+
+        with REDIS_TIME.time(command="xadd" if self.transport == "stream" else "rpush"):
+            results = pipe.execute()
+        with MQTT_TIME.time():
+            for res in published:
+                res.wait_for_publish()
+        # after the lines, so a subscriber never has a state ahead of the log topics
+        for server in changed:
+            self.src.publish(
+                server_topic("state", server), self.states[server].to_json(), qos=1, retain=True
+            )
+            STATES_PUBLISHED.inc()
+
+        if any(self.indexers):
+            for (server, robj), length in zip(robjs, results, strict=True):
+                self.indexers[server].feed(length - 1, robj)
+
+
+class LiveState(object):
+    """The current game on one server, kept up to date from its parsed lines
+
+    Published retained on q3server/state, so any subscriber gets the map, players
+    and running scores on connect, without asking the server over rcon. We only
+    follow new lines, so nothing is published until the first InitGame or
+    ShutdownGame; until then, the retained state from before a restart stands.
+    """
+
+    def __init__(self):
+        self.game = dict()  # InitGame settings, mapname, fraglimit etc.
+        self.clients = dict()  # client id -> {"n": name, "running_score": kills}
+        self.timestamp = None  # of the last line applied
+        self.complete = False
+
+    def feed(self, action, payload):
+        """Apply one event; returns True if the state changed"""
+        if action == "InitGame":
+            self.game = {k: v for k, v in payload.items() if k not in ("timestamp", "line")}
+            self.game["fraglimit"] = int(self.game.get("fraglimit", 100))
+            self.clients = dict()
+            self.complete = True
+        elif action == "ShutdownGame":
+            self.game = dict()
+            self.clients = dict()
+            self.complete = True
+        elif action == "Client":
+            clidx = payload["clientid"]
+            if payload["action"] == "Disconnect":
+                if self.clients.pop(clidx, None) is None:
+                    return False
+            else:
+                cli = self.clients.setdefault(clidx, dict())
+                if "n" in payload:
+                    cli["n"] = payload["n"]
+        elif action == "Kill":
+            if payload["clientid"] == IX_WORLD:  # falling damage, etc.
+                clidx, name_ = payload["targetid"], payload["targetn"]
+            else:
+                clidx, name_ = payload["clientid"], payload["n"]
+            self.clients.setdefault(payload["targetid"], dict()).setdefault("n", payload["targetn"])
+            cli = self.clients.setdefault(clidx, dict())
+            cli.setdefault("n", name_)
+            score = cli.get("running_score", 0)
+            cli["running_score"] = score - 1 if clidx == payload["targetid"] else score + 1
+        else:
+            return False
+        self.timestamp = payload["timestamp"]
+        return self.complete
+
+    def to_json(self):
+        return json.dumps({"timestamp": self.timestamp, "game": self.game, "clients": self.clients})
+
+
+def parse_stage(lines, parsed, batch_size, profiler=None):
+    """Parse (server, line) from one queue into (server, event) on the next
+
+    A line that can't be parsed is logged and dropped. With a profiler, each batch
+    is a section of it, since cProfile only sees the thread that enables it.
+    """
+    while True:
+        batch = lines.get_batch(batch_size)
+        if len(batch) == 0:
+            continue
+        with profiler.section() if profiler is not None else nullcontext():
+            for server, line in batch:
+                if line is None:
+                    parsed.put((server, None))  # pass on the end of the log
+                    continue
+                try:
+                    obj = parse(line)
+                except Exception as ex:
+                    logger.exception(f"Couldn't parse {line!r}, dropping it", exc_info=ex)
+                    LINES_DROPPED.inc(action="error")
+                    continue
+                if obj is not None:
+                    parsed.put((server, obj))
 
 
 def main():
+    global PROFILER
+    import paho.mqtt.client as mqtt
+
+    setup_logging("mqtt.log")
+    PROFILER = Profiler(
+        "q3container", CONFIG.get("profile_dir", "profiles"), int(CONFIG.get("profile_top", "10"))
+    )
+
     src = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, "q3bot")
     src.on_connect = on_connect
     src.on_message = on_message
     src.enable_logger(logger)
-    src.connect(MQTTSERVER)
+    src.connect(CONFIG.get("mqtt", "q3mosquitto"))
 
     src.loop_start()
     src.publish("q3server/status", "hello", retain=True)
     src.will_set("q3server/status", "offline", retain=True)
 
-    rhost = CONFIG.get("redishost", "q3redis")
-    rport = int(CONFIG.get("redisport", "6379"))
-    rdb = int(CONFIG.get("redisdb", "0"))
-    r = redis.Redis(host=rhost, port=rport, db=rdb)
+    r = redis_client()
 
-    for line in handle_log():
-        obj = parse_line(line)
-        if obj is None:
+    # containers=name:container,... follows several servers, namespacing their
+    # topics and keys by name; otherwise it's just q3server, un-namespaced
+    if "containers" in CONFIG:
+        servers = parse_servers(CONFIG["containers"])
+    else:
+        servers = {None: "q3server"}
+    writer = Writer(src, r, CONFIG.get("transport", "mqtt"), list(servers))
+    batch_size = int(CONFIG.get("write_batch", "100"))
+
+    start_server(int(CONFIG.get("container_metrics_port", "9101")), CONFIG.get("metrics_host", ""))
+
+    profile_seconds = CONFIG.get("profile_container_seconds")
+    if profile_seconds is not None:
+        PROFILER.start(seconds=float(profile_seconds))
+    PROFILER.on_finish = lambda summary: src.publish("q3server/profile", summary, qos=1)
+
+    # reader threads -> lines -> parse thread -> parsed -> writer (this thread)
+    queue_size = int(CONFIG.get("queue_size", "10000"))
+    spill = r if CONFIG.get("queue_overflow", "block") == "spill" else None
+    lines = StageQueue("lines", queue_size, spill)
+    parsed = StageQueue("parsed", queue_size)
+    parser = threading.Thread(
+        target=parse_stage, args=(lines, parsed, batch_size, PROFILER), name="parse", daemon=True
+    )
+    parser.start()
+    for server, container in servers.items():
+        name = f"follow-{server or container}"
+        threading.Thread(
+            target=follow, args=(server, container, lines), name=name, daemon=True
+        ).start()
+
+    while not SHUTDOWN:
+        batch = parsed.get_batch(batch_size)
+        if len(batch) == 0:
+            if not parser.is_alive():
+                logger.error("The parse thread died, stopping")
+                break
             continue
-        logger.info(f"Publishing {obj}")
-        path = f"q3server/log/{obj['action']}"
-        if "clientid" in obj:
-            path += f"/{obj['clientid']}"
-        if "content" in obj:
-            res = src.publish(path, obj["content"], qos=2)
-            res.wait_for_publish()
 
-            robj = redis_line(obj)
-            r.rpush("q3log", robj)
-        else:
-            logger.error(f"No content in {obj}")
-        if SHUTDOWN:
+        with PROFILER.section():
+            writer.write([(server, obj) for server, obj in batch if obj is not None])
+        if any(obj is None for _, obj in batch):
+            logger.error("A container log ended, stopping")
             break
 
     src.loop_stop()
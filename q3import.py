@@ -0,0 +1,304 @@
+"""Bulk import of legacy games.log/qconsole.log files
+
+Files are memory-mapped and cut into games at InitGame lines (each game runs to
+the next InitGame, so it includes its ShutdownGame). Batches of games are parsed
+in a process pool with the same parse_line as q3container, and either folded
+into compact game records for q3games (the default), or appended to q3log as raw
+lines, as if they had been read from the container.
+
+q3log is read in order, so lines are only appended to a log that ends before the
+first imported game, typically an empty one; and q3container must be stopped
+meanwhile, or its lines get mixed into the imported games. Old games go to
+q3games instead, which is keyed by start time.
+
+games.log only has a game clock (minutes:seconds since the server started), so
+absolute times are anchored at --start, or by default at the file's modification
+time for its last line. qconsole.log lines have no clock at all, so they are
+spaced a millisecond apart. Run `python q3index.py rebuild` after importing.
+"""
+
+import argparse
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+from dateutil.parser import parse
+
+from q3constants import TZ, redis_client, server_key
+from q3container import parse_line, redis_line
+from q3parselog import COMPACT_KEY, LOG_KEY, Q3LogParse, game_to_record
+
+logger = logging.getLogger(__name__)
+
+CLOCK_RE = re.compile(r"^ *(\d+):(\d\d) ")  # games.log game clock, as "  mm:ss "
+INITGAME = b"InitGame:"
+RESTART_GAP = 1.0  # seconds assumed between a server restart and its first game
+
+
+def game_clock(line):
+    """(seconds on the game clock, rest of the line), or (None, line) if untimed"""
+    match = CLOCK_RE.match(line)
+    if match is None:
+        return None, line
+    return int(match[1]) * 60 + int(match[2]), line[match.end() :]
+
+
+def docker_timestamp(seconds):
+    """Unix time in the format of docker log timestamps, which parse_line expects"""
+    dt = datetime.fromtimestamp(seconds, timezone.utc)
+    return f"{dt:%Y-%m-%dT%H:%M:%S}.{dt.microsecond:06d}000Z"
+
+
+def find_games(mm):
+    """Byte offsets of the InitGame lines in a mapped log"""
+    starts = list()
+    pos = mm.find(INITGAME)
+    while pos >= 0:
+        line_start = mm.rfind(b"\n", 0, pos) + 1
+        prefix = mm[line_start:pos].decode("utf-8", errors="replace")
+        if prefix.strip() == "" or CLOCK_RE.fullmatch(prefix):  # not someone saying it
+            starts.append(line_start)
+        pos = mm.find(INITGAME, pos + 1)
+    return starts
+
+
+def plan_games(mm, starts):
+    """Place each game in time, relative to the start of the log
+
+    Returns ([(start offset, end offset, time of its clock zero)], time the last
+    game ended), in seconds. The game clock restarts with the server, so a game
+    whose clock is behind where the previous one ended starts a new session, right
+    after it.
+    """
+    games = list()
+    session = 0.0  # time of the current server session's clock zero
+    end_time = None  # of the previous game
+    for i, start in enumerate(starts):
+        end = starts[i + 1] if i + 1 < len(starts) else len(mm)
+        first_end = mm.find(b"\n", start, end)
+        first_end = first_end if first_end >= 0 else end
+        first, _ = game_clock(mm[start:first_end].decode("utf-8", errors="replace"))
+        last_start = mm.rfind(b"\n", start, end - 1) + 1
+        last, _ = game_clock(mm[last_start:end].decode("utf-8", errors="replace"))
+
+        if first is None or last is None:  # untimed: a millisecond per line
+            base = end_time + RESTART_GAP if end_time is not None else 0.0
+            end_time = base + mm[start:end].count(b"\n") / 1000
+        else:
+            if end_time is not None and session + first < end_time:
+                session = end_time + RESTART_GAP - first
+            base = session
+            end_time = base + last
+        games.append((start, end, base))
+    return games, end_time or 0.0
+
+
+def make_batches(path, games, anchor, batch_bytes):
+    """Group consecutive games into pool tasks of roughly batch_bytes"""
+    batch = list()
+    size = 0
+    for start, end, base in games:
+        batch.append((start, end, anchor + base))
+        size += end - start
+        if size >= batch_bytes:
+            yield path, batch
+            batch = list()
+            size = 0
+    if any(batch):
+        yield path, batch
+
+
+def game_events(text, base):
+    """parse_line events of one game's lines, timed from its clock zero"""
+    for i, line in enumerate(text.splitlines()):
+        clock, rest = game_clock(line)
+        if clock is None:
+            seconds = base + i / 1000
+        else:  # the clock only has seconds, so keep lines in order within them
+            seconds = base + clock + i / 1e6
+        if not rest.strip():
+            continue
+        buildobj = parse_line(f"{docker_timestamp(seconds)} {rest.strip()}")
+        if buildobj is not None:
+            yield buildobj
+
+
+def parse_batch(task, target="games"):
+    """Pool worker: parse a batch of games from a file
+
+    Returns (bytes, events, output); output is {start: game record} for the
+    "games" target, or a list of q3log lines for "log".
+    """
+    path, batch = task
+    events = 0
+    size = 0
+    parsed = Q3LogParse(keep_games=True)
+    lines = list()
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for start, end, base in batch:
+            size += end - start
+            text = mm[start:end].decode("utf-8", errors="replace")
+            for buildobj in game_events(text, base):
+                events += 1
+                if target == "log":
+                    lines.append(redis_line(buildobj))
+                else:
+                    parsed.handle_message(None, buildobj)
+
+    if target == "log":
+        return size, events, lines
+    records = {
+        ts.isoformat(): game_to_record(game) for ts, game in parsed.games.items() if "scores" in game
+    }
+    return size, events, records
+
+
+def parse_batch_log(task):
+    return parse_batch(task, "log")
+
+
+def plan_file(path, start=None):
+    """Place the games of one file in time
+
+    Returns (games as from plan_games, Unix time of the log's clock zero, Unix
+    time the last game ended).
+
+    Args:
+        path: Log file
+        start: Unix time of the first game; by default the last game ends at the
+               file's modification time
+    """
+    if os.path.getsize(path) == 0:  # can't be mapped
+        games, length = list(), 0.0
+    else:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            games, length = plan_games(mm, find_games(mm))
+    anchor = start if start is not None else os.path.getmtime(path) - length
+    logger.info(f"{path}: {len(games)} games from {docker_timestamp(anchor)}")
+    return games, anchor, anchor + length
+
+
+class OutOfOrder(ValueError):
+    pass
+
+
+def check_log_tail(r, log_key, first):
+    """Refuse to append lines from before the end of the log
+
+    A game's events run until the next InitGame, and the bot restores its state by
+    walking back from the tail to a timestamp, so older lines at the end would be
+    mixed into the game in progress, and cut that walk short.
+    """
+    last = r.lindex(log_key, -1)
+    if last is None:
+        return
+    last_ts = parse(json.loads(last)["timestamp"])
+    if first <= last_ts.timestamp():
+        raise OutOfOrder(
+            f"{log_key} ends at {last_ts:%Y-%m-%d %H:%M:%S}, after the first imported game"
+            f" at {docker_timestamp(first)}; import to q3games (--target games) instead"
+        )
+
+
+def import_logs(r, paths, target="games", start=None, workers=None, batch_mb=8, server=None):
+    """Import log files into Redis
+
+    Args:
+        r: Redis client
+        paths: Log files, oldest first
+        target: "games" for compact records in q3games, "log" to append to q3log,
+                which has to end before the first game (see check_log_tail)
+        start: datetime of the first game; later files follow on from the previous
+        workers: Pool size, default all cores
+        batch_mb: Size of each pool task
+        server: Game server name, when following several
+
+    Returns:
+        (bytes read, events parsed, games or lines written)
+    """
+    tasks = list()
+    next_start = start.timestamp() if start is not None else None
+    for path in paths:
+        games, anchor, end = plan_file(path, next_start)
+        tasks += make_batches(path, games, anchor, batch_mb * 1024 * 1024)
+        if next_start is not None:
+            next_start = end + RESTART_GAP
+    if target == "log" and any(tasks):
+        _, batch = tasks[0]
+        check_log_tail(r, server_key(LOG_KEY, server), batch[0][2])
+
+    worker = parse_batch if target == "games" else parse_batch_log
+    total_bytes = total_events = written = 0
+    with multiprocessing.Pool(workers) as pool:
+        # imap keeps the batches in order, which matters for q3log
+        for size, events, output in pool.imap(worker, tasks):
+            total_bytes += size
+            total_events += events
+            if not any(output):
+                continue
+            if target == "games":
+                r.hset(server_key(COMPACT_KEY, server), mapping=output)
+            else:
+                pipe = r.pipeline(transaction=False)
+                for i in range(0, len(output), 10000):
+                    pipe.rpush(server_key(LOG_KEY, server), *output[i : i + 10000])
+                pipe.execute()
+            written += len(output)
+    return total_bytes, total_events, written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import legacy games.log/qconsole.log files")
+    parser.add_argument("paths", nargs="+", help="log files, oldest first")
+    parser.add_argument(
+        "--target",
+        choices=["games", "log"],
+        default="games",
+        help="store compact game records (default), or append raw lines to q3log; that log"
+        " has to end before the first game, and q3container must be stopped meanwhile",
+    )
+    parser.add_argument(
+        "--start",
+        help="date/time of the first game; by default each file ends at its modification time",
+    )
+    parser.add_argument("--workers", type=int, help="parser processes, default all cores")
+    parser.add_argument("--batch-mb", type=int, default=8, help="MiB of log per parser task")
+    parser.add_argument("--server", help="game server name, when following several")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    start = None
+    if args.start is not None:
+        start = parse(args.start)
+        if start.tzinfo is None:
+            start = TZ.localize(start)
+
+    r = redis_client()
+
+    began = time.monotonic()
+    try:
+        size, events, written = import_logs(
+            r, args.paths, args.target, start, args.workers, args.batch_mb, args.server
+        )
+    except OutOfOrder as ex:
+        print(ex)
+        return 1
+    elapsed = max(time.monotonic() - began, 1e-9)
+    what = "games" if args.target == "games" else "lines"
+    print(
+        f"Imported {written} {what} from {size / 1024**2:.1f} MiB ({events} events)"
+        f" in {timedelta(seconds=round(elapsed))}:"
+        f" {size / 1024**2 / elapsed:.1f} MiB/s, {events / elapsed:.0f} events/s"
+    )
+    print("Run `python q3index.py rebuild` to index the imported games")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
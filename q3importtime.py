@@ -0,0 +1,100 @@
+"""Startup benchmark: import time of each module, against a budget
+
+Each module is imported in a fresh `python -X importtime` from an empty directory,
+so there's no secrets.ini to read, and anything that still connects to docker or
+Redis on import fails. The best of --repeat runs is compared with the module's
+budget; the exit code is 1 if any module is over budget or fails to import.
+"""
+
+import argparse
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+
+# milliseconds, cumulative (the module and everything it imports)
+BUDGETS = {
+    "q3constants": 60,
+    "q3metrics": 80,
+    "q3profile": 60,
+    "q3parselog": 80,
+    "q3index": 80,
+    "q3compact": 80,
+    "q3sqlite": 100,
+    "q3stream": 100,
+    "q3container": 150,
+    "q3import": 200,
+    "q3api": 100,
+    "q3loadtest": 200,
+    "q3bot": 800,  # discord.py is most of it
+}
+
+
+def import_times(module, cwd, env):
+    """(cumulative µs, {direct import: cumulative µs}) for one fresh import of module"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+    # lines come after everything they imported, nested two spaces per level
+    children = dict()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == module:
+                return int(cumulative), children
+            children = dict()  # something imported before, like site
+        elif depth == 1:
+            children[name.strip()] = int(cumulative)
+    raise RuntimeError(f"{module} not in the -X importtime output")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check module import times against budgets")
+    parser.add_argument("modules", nargs="*", help=f"default {', '.join(BUDGETS)}")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per module, best is used")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply all budgets")
+    parser.add_argument("--top", type=int, default=3, help="heaviest imports to list per module")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [str(Path(__file__).resolve().parent)] + env.get("PYTHONPATH", "").split(os.pathsep)
+    )
+
+    failed = False
+    with tempfile.TemporaryDirectory() as cwd:
+        for module in args.modules or BUDGETS:
+            budget = BUDGETS.get(module, 100) * args.scale
+            try:
+                runs = [import_times(module, cwd, env) for _ in range(args.repeat)]
+            except RuntimeError as ex:
+                print(f"{module:<12}  FAILED: {ex}")
+                failed = True
+                continue
+
+            total, children = min(runs, key=lambda run: run[0])
+            over = total / 1000 > budget
+            failed |= over
+            heaviest = sorted(children.items(), key=lambda kv: kv[1], reverse=True)
+            heavy_ = ", ".join(f"{n} {us / 1000:.0f}" for n, us in heaviest[: args.top])
+            print(
+                f"{module:<12} {total / 1000:7.1f}ms / {budget:5.0f}ms"
+                f" {'OVER' if over else 'ok  '}  ({heavy_})"
+            )
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,397 @@
+"""Per-game indexes kept in Redis, updated once as each game finishes
+
+Indexes are Q3LogParse sinks. The log writer feeds every archived line through an
+Indexer, so each finished game is folded in once; the bot then answers lookups
+from a couple of small Redis keys instead of replaying the log.
+Each index keeps a watermark (start time of the last game folded in), which makes
+replaying old games a no-op, and lets `python q3index.py rebuild` catch up.
+"""
+
+import argparse
+import json
+import logging
+import operator
+
+from q3constants import CONFIG, redis_client, server_key
+from q3parselog import Q3LogParse, last_game_lines, render_name
+
+logger = logging.getLogger(__name__)
+
+
+def best(counts, exclude=None):
+    """(key, count) with the highest count, or (None, 0)"""
+    items = [(k, v) for k, v in counts.items() if k != exclude and v > 0]
+    if not any(items):
+        return None, 0
+    return max(items, key=operator.itemgetter(1))
+
+
+class GameIndex(object):
+    name = None
+
+    def __init__(self, r, server=None):
+        self.r = r
+        self.server = server
+
+    def key(self, key):
+        return server_key(key, self.server)
+
+    @property
+    def watermark_key(self):
+        return self.key(f"q3index:{self.name}:last")
+
+    def game_finished(self, ts, game):
+        last = self.r.get(self.watermark_key)
+        if last is not None and ts.timestamp() <= float(last):
+            return False  # already folded in
+
+        pipe = self.r.pipeline()
+        self.fold(pipe, ts, game)
+        pipe.set(self.watermark_key, ts.timestamp())
+        pipe.execute()
+        return True
+
+    def fold(self, pipe, ts, game):
+        """Queue the index updates for one finished game on a pipeline"""
+        raise NotImplementedError
+
+    def keys(self):
+        """All keys making up this index"""
+        return [self.watermark_key]
+
+    def reset(self):
+        keys = self.keys()
+        if any(keys):
+            self.r.delete(*keys)
+
+
+class PlayerIndex(GameIndex):
+    """Per-player totals: games, wins, map scores, weapons, victims and killers
+
+    q3player:<name> is a hash of games, wins, map:<map>, weapon:<weapon>,
+    kill:<target> and killedby:<killer>; q3players maps lowercase names to names.
+    """
+
+    name = "player"
+    NAMES_KEY = "q3players"
+
+    def player_key(self, name):
+        return self.key(f"q3player:{name}")
+
+    def fold(self, pipe, ts, game):
+        names = dict()
+        for pl, score in game["scores"].items():
+            key = self.player_key(pl)
+            names[pl.lower()] = pl
+            pipe.hincrby(key, "games", 1)
+            pipe.hincrby(key, f"map:{game['mapname']}", score)
+        for pl in game["winners"]:
+            pipe.hincrby(self.player_key(pl), "wins", 1)
+        for pl, dmod in game["weapons"].items():
+            for mod, kills in dmod.items():
+                pipe.hincrby(self.player_key(pl), f"weapon:{mod}", kills)
+        for pl, dtgt in game["kills"].items():
+            names.setdefault(pl.lower(), pl)
+            for tgt, kills in dtgt.items():
+                names.setdefault(tgt.lower(), tgt)
+                pipe.hincrby(self.player_key(pl), f"kill:{tgt}", kills)
+                pipe.hincrby(self.player_key(tgt), f"killedby:{pl}", kills)
+        pipe.hset(self.key(self.NAMES_KEY), mapping=names)
+
+    def keys(self):
+        names = [n.decode("utf-8") for n in self.r.hvals(self.key(self.NAMES_KEY))]
+        return super().keys() + [self.key(self.NAMES_KEY)] + [self.player_key(n) for n in names]
+
+    def name_field(self, name):
+        """(key, field) of a name, in any capitalization, in the names hash"""
+        return self.key(self.NAMES_KEY), name.lower()
+
+    @staticmethod
+    def found_name(found):
+        return found.decode("utf-8") if found is not None else None
+
+    def canonical_name(self, name):
+        """Name as recorded, from any capitalization, or None"""
+        return self.found_name(self.r.hget(*self.name_field(name)))
+
+    def lookup(self, name):
+        """Returns (name, stats hash) for a player, or (None, None)"""
+        name = self.canonical_name(name)
+        if name is None:
+            return None, None
+        return name, self.r.hgetall(self.player_key(name))
+
+    async def acanonical_name(self, name):
+        """canonical_name, with a redis.asyncio client"""
+        return self.found_name(await self.r.hget(*self.name_field(name)))
+
+    async def alookup(self, name):
+        """lookup, with a redis.asyncio client"""
+        name = await self.acanonical_name(name)
+        if name is None:
+            return None, None
+        return name, await self.r.hgetall(self.player_key(name))
+
+
+class RatingIndex(GameIndex):
+    """Elo ratings for free-for-all games, updated from the final scores
+
+    Each game counts as a round robin of pairwise results, with K split between
+    the opponents. q3rating is a sorted set of ratings, q3rating:games a hash of
+    games rated per player.
+    """
+
+    name = "rating"
+    RATING_KEY = "q3rating"
+    GAMES_KEY = "q3rating:games"
+
+    def __init__(self, r, server=None, k=None, start=None):
+        super().__init__(r, server)
+        self.k = float(k if k is not None else CONFIG.get("rating_k", "32"))
+        self.start = float(start if start is not None else CONFIG.get("rating_start", "1000"))
+
+    def fold(self, pipe, ts, game):
+        players = list(game["scores"])
+        current = self.r.zmscore(self.key(self.RATING_KEY), players)
+        ratings = {
+            pl: rating if rating is not None else self.start
+            for pl, rating in zip(players, current, strict=True)
+        }
+
+        for pl, rating in self.update(ratings, game["scores"]).items():
+            pipe.zadd(self.key(self.RATING_KEY), {pl: rating})
+            pipe.hincrby(self.key(self.GAMES_KEY), pl, 1)
+
+    def update(self, ratings, scores):
+        """New ratings from old ratings and one game's scores"""
+        opponents = len(scores) - 1
+        new_ratings = dict()
+        for pl, rating in ratings.items():
+            delta = 0.0
+            for opp, opp_rating in ratings.items():
+                if opp == pl:
+                    continue
+                expected = 1 / (1 + 10 ** ((opp_rating - rating) / 400))
+                if scores[pl] > scores[opp]:
+                    actual = 1.0
+                elif scores[pl] == scores[opp]:
+                    actual = 0.5
+                else:
+                    actual = 0.0
+                delta += actual - expected
+            new_ratings[pl] = rating + self.k * delta / opponents
+        return new_ratings
+
+    def keys(self):
+        return super().keys() + [self.key(self.RATING_KEY), self.key(self.GAMES_KEY)]
+
+    def ladder(self, count=10):
+        """Returns [(name, rating, games)], best first"""
+        top = self.r.zrevrange(*self.top_range(count), withscores=True)
+        if not any(top):
+            return list()
+        return self.ladder_rows(top, self.r.hmget(*self.games_fields(top)))
+
+    async def aladder(self, count=10):
+        """ladder, with a redis.asyncio client"""
+        top = await self.r.zrevrange(*self.top_range(count), withscores=True)
+        if not any(top):
+            return list()
+        return self.ladder_rows(top, await self.r.hmget(*self.games_fields(top)))
+
+    def top_range(self, count):
+        return self.key(self.RATING_KEY), 0, count - 1
+
+    def games_fields(self, top):
+        return self.key(self.GAMES_KEY), [pl for pl, _ in top]
+
+    @staticmethod
+    def ladder_rows(top, games):
+        return [
+            (pl.decode("utf-8"), rating, int(gm or 0))
+            for (pl, rating), gm in zip(top, games, strict=True)
+        ]
+
+
+class VersusIndex(GameIndex):
+    """Head-to-head kill matrix
+
+    q3vs:<player>:<target> is a hash of kills, and weapon:<weapon> kills, of
+    player on target.
+    """
+
+    name = "versus"
+
+    def pair_key(self, player, target):
+        return self.key(f"q3vs:{player}:{target}")
+
+    def fold(self, pipe, ts, game):
+        duels = game.get("duels", dict())  # not in games compacted before it was added
+        for pl, dtgt in game["kills"].items():
+            for tgt, kills in dtgt.items():
+                if tgt == pl:
+                    continue
+                key = self.pair_key(pl, tgt)
+                pipe.hincrby(key, "kills", kills)
+                for mod, mkills in duels.get(pl, dict()).get(tgt, dict()).items():
+                    pipe.hincrby(key, f"weapon:{mod}", mkills)
+
+    def keys(self):
+        return super().keys() + list(self.r.scan_iter(match=self.pair_key("*", "*")))
+
+    def lookup(self, player, target):
+        """Returns the pair hashes for (player on target, target on player)"""
+        with self.r.pipeline() as pipe:
+            return tuple(self.queue_lookup(pipe, player, target).execute())
+
+    async def alookup(self, player, target):
+        """lookup, with a redis.asyncio client"""
+        async with self.r.pipeline() as pipe:
+            return tuple(await self.queue_lookup(pipe, player, target).execute())
+
+    def queue_lookup(self, pipe, player, target):
+        pipe.hgetall(self.pair_key(player, target))
+        pipe.hgetall(self.pair_key(target, player))
+        return pipe
+
+
+def render_versus(player, target, kills, deaths):
+    """One message with a head-to-head, from the VersusIndex pair hashes"""
+    lines = [f"**{render_name(player)}** vs **{render_name(target)}**"]
+    for killer, victim, data in ((player, target, kills), (target, player, deaths)):
+        totals, groups = split_fields(data)
+        line = f"{render_name(killer)} killed {render_name(victim)} _{totals.get('kills', 0)}_ times"
+        weapon, wkills = best(groups.get("weapon", dict()))
+        if weapon is not None:
+            line += f", mostly with {weapon} (_{wkills}_)"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def render_ladder(ladder):
+    """One message with the rating ladder"""
+    if not any(ladder):
+        return "No rated games yet"
+    lines = ["**Ladder**"]
+    for i, (pl, rating, games) in enumerate(ladder, start=1):
+        lines.append(f" {i}) {render_name(pl)}: _{rating:.0f}_ ({games} games)")
+    return "\n".join(lines)
+
+
+def split_fields(data):
+    """Turn a q3player hash into plain totals and {prefix: {key: count}}"""
+    totals = dict()
+    groups = dict()
+    for field, value in data.items():
+        field = field.decode("utf-8") if isinstance(field, bytes) else field
+        prefix, sep, key = field.partition(":")
+        if sep:
+            groups.setdefault(prefix, dict())[key] = int(value)
+        else:
+            totals[field] = int(value)
+    return totals, groups
+
+
+def render_player(name, data):
+    """One message summarizing a player, from their PlayerIndex hash"""
+    totals, groups = split_fields(data)
+    games = totals.get("games", 0)
+    wins = totals.get("wins", 0)
+    frac = wins / games if games > 0 else 0.0
+
+    lines = [f"**{render_name(name)}**: {wins} wins in {games} games ({100 * frac:.0f}% win ratio)"]
+
+    bestmap, _ = best(groups.get("map", dict()))
+    if bestmap is not None:
+        lines.append(f"Best map: _{bestmap}_")
+
+    weapons = sorted(groups.get("weapon", dict()).items(), key=operator.itemgetter(1), reverse=True)
+    if any(weapons):
+        weap_ = ", ".join(f"{w} (_{k}_)" for w, k in weapons[:3])
+        lines.append(f"Favourite weapons: {weap_}")
+
+    victim, kills = best(groups.get("kill", dict()), exclude=name)
+    if victim is not None:
+        lines.append(f"Favourite victim: {render_name(victim)} (_{kills}_ kills)")
+    nemesis, deaths = best(groups.get("killedby", dict()), exclude=name)
+    if nemesis is not None:
+        lines.append(f"Nemesis: {render_name(nemesis)} (_{deaths}_ deaths)")
+    suicides = groups.get("kill", dict()).get(name, 0)
+    if suicides > 0:
+        lines.append(f"Suicides: _{suicides}_")
+
+    return "\n".join(lines)
+
+
+class Indexer(object):
+    """Follows archived log lines, updating the indexes as each game finishes"""
+
+    def __init__(self, r, indexes):
+        self.r = r
+        self.parsed = Q3LogParse(r, sinks=indexes, keep_games=False)
+
+    def feed(self, idx, robj):
+        """Feed one line, as stored in q3log"""
+        self.parsed.handle_message(idx, json.loads(robj))
+
+    def resume(self, server=None):
+        """Catch up on the game in progress, from its InitGame in the log
+
+        Call before following new lines, or a game running across a restart is
+        never folded in. A game that's already finished there was folded in before,
+        so the watermarks make that a no-op. Returns the number of lines fed.
+        """
+        offset, lines = last_game_lines(self.r, server)
+        for i, robj in enumerate(lines):
+            self.feed(offset + i, robj)
+        return len(lines)
+
+
+def all_indexes(r, server=None):
+    return [PlayerIndex(r, server), RatingIndex(r, server), VersusIndex(r, server)]
+
+
+def rebuild(r, indexes, server=None):
+    """Reset the indexes, and fold in every game in the log
+
+    Games the log writer finishes meanwhile move the watermarks past the older
+    games, so stop it while rebuilding.
+    """
+    parsed = Q3LogParse(r, server=server)
+    parsed.parse_log()
+    for index in indexes:
+        index.reset()
+    games = 0
+    for ts, game in parsed.finished_games():
+        for index in indexes:
+            index.game_finished(ts, game)
+        games += 1
+    return games
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the q3 stats indexes")
+    parser.add_argument("command", choices=["rebuild", "player", "ladder", "vs"])
+    parser.add_argument("name", nargs="*", help="player(s) to look up, or ladder length")
+    parser.add_argument("--server", help="game server name, when following several")
+    args = parser.parse_args()
+
+    r = redis_client()
+
+    if args.command == "rebuild":
+        games = rebuild(r, all_indexes(r, args.server), args.server)
+        print(f"Indexed {games} games")
+    elif args.command == "player":
+        name, data = PlayerIndex(r, args.server).lookup(args.name[0])
+        print(render_player(name, data) if name is not None else f"No player {args.name[0]}")
+    elif args.command == "ladder":
+        print(
+            render_ladder(RatingIndex(r, args.server).ladder(int(args.name[0]) if args.name else 10))
+        )
+    elif args.command == "vs":
+        player, target = (PlayerIndex(r, args.server).canonical_name(n) or n for n in args.name[:2])
+        print(render_versus(player, target, *VersusIndex(r, args.server).lookup(player, target)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""Load test: replay a log through the q3container pipeline at a multiple of real time
+
+A captured log (`docker logs -t q3server`, or a games.log), or a synthetic bot
+match, is fed as docker log chunks through the same stages as q3container:
+assemble_lines, the parse thread, and the Writer to Redis and MQTT. A subscriber
+on the log topics stands in for the bot's on_mqtt_message, and the time from
+each line's last byte to its arrival there is reported as percentiles.
+
+Lines are re-stamped with the time they're sent, and everything goes to the
+"loadtest" server's keys and topics, without updating the stats indexes. After
+each run its q3log is deleted and its retained state cleared, so nothing is left
+next to a live setup. With --in-process, Redis is fakeredis and MQTT is a
+loopback broker in this process, so nothing needs to run; otherwise it's the
+Redis and broker from the config.
+"""
+
+import argparse
+import json
+import queue
+import random
+import sys
+import threading
+import time
+
+from q3constants import CONFIG, redis_client, server_key, server_topic
+from q3container import StageQueue, Writer, assemble_lines, parse_stage
+from q3import import docker_timestamp, game_clock
+from q3parselog import LOG_KEY
+
+DOCKER_TS_LEN = len("2024-01-01T12:00:00.000000000Z")
+
+
+def read_timeline(path):
+    """[(seconds from the first line, line text)] of a captured log
+
+    Docker timestamps are used as they are, games.log lines are timed by their
+    game clock, and anything else is spaced a millisecond apart.
+    """
+    from dateutil.parser import parse
+
+    timeline = list()
+    first = None
+    clock_base = 0.0  # the game clock restarts with the server
+    last = 0.0
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for text in f:
+            text = text.rstrip("\r\n")
+            if not text.strip():
+                continue
+            head, _, rest = text.partition(" ")
+            if len(head) == DOCKER_TS_LEN and head.endswith("Z"):
+                seconds = parse(head).timestamp()
+                first = seconds if first is None else first
+                at, text = seconds - first, rest
+            else:
+                clock, text = game_clock(text)
+                if clock is None:
+                    at = last + 0.001
+                else:
+                    if clock_base + clock < last:
+                        clock_base = last
+                    at = clock_base + clock
+            last = max(last, at)
+            timeline.append((at, text.strip()))
+    return timeline
+
+
+def synthetic_match(players=32, minutes=10.0, kills_per_second=4.0, seed=None):
+    """[(seconds, line text)] of one bot match: joins, kills, scores and the end"""
+    rng = random.Random(seed)
+    names = [f"Bot{i:02d}" for i in range(players)]
+    timeline = [(0.0, r"InitGame: \sv_hostname\loadtest\mapname\q3dm17\fraglimit\0")]
+    for i, name in enumerate(names):
+        at = 0.1 + i * 0.05
+        timeline.append((at, f"ClientConnect: {i}"))
+        timeline.append((at, rf"ClientUserinfoChanged: {i} n\{name}\t\0\model\sarge"))
+        timeline.append((at, f"ClientBegin: {i}"))
+
+    scores = dict.fromkeys(range(players), 0)
+    at = 0.1 + players * 0.05
+    end = minutes * 60
+    weapons = [(10, "MOD_RAILGUN"), (7, "MOD_ROCKET_SPLASH"), (3, "MOD_SHOTGUN"), (8, "MOD_PLASMA")]
+    while True:
+        at += rng.expovariate(kills_per_second)
+        if at >= end:
+            break
+        killer, target = rng.randrange(players), rng.randrange(players)
+        methodid, method = rng.choice(weapons)
+        scores[killer] += -1 if killer == target else 1
+        timeline.append(
+            (
+                at,
+                f"Kill: {killer} {target} {methodid}:"
+                f" {names[killer]} killed {names[target]} by {method}",
+            )
+        )
+
+    timeline.append((end, "Exit: Timelimit hit."))
+    for i, name in enumerate(names):
+        timeline.append((end, f"score: {scores[i]}  ping: 50  client: {i} {name}"))
+    timeline.append((end + 1, "ShutdownGame:"))
+    return timeline
+
+
+class Loopback(object):
+    """In-process stand-in for the broker, with one subscriber callback"""
+
+    class Message(object):
+        def __init__(self, topic, payload):
+            self.topic = topic
+            self.payload = payload if isinstance(payload, bytes) else payload.encode("utf-8")
+
+    class Published(object):
+        def wait_for_publish(self):
+            pass
+
+    def __init__(self, on_message):
+        self.on_message = on_message
+        self.messages = queue.Queue()
+        threading.Thread(target=self.deliver, name="loopback", daemon=True).start()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.messages.put(self.Message(topic, payload))
+        return self.Published()
+
+    def deliver(self):
+        while True:
+            self.on_message(self, None, self.messages.get())
+
+
+class Probe(object):
+    """Stands in for the bot: times each log event's arrival in on_mqtt_message"""
+
+    def __init__(self, server):
+        self.prefix = server_topic("log/", server)
+        self.sent = dict()  # line timestamp -> monotonic time its last byte was sent
+        self.latencies = list()
+        self.lock = threading.Lock()
+
+    def on_mqtt_message(self, client, userdata, msg):
+        arrived = time.monotonic()
+        if not msg.topic.startswith(self.prefix):
+            return
+        payload = json.loads(msg.payload.decode("utf-8"))
+        with self.lock:
+            sent = self.sent.pop(payload["timestamp"], None)
+            if sent is not None:
+                self.latencies.append(arrived - sent)
+
+
+def chunks(timeline, speed, probe, byte_mode=True):
+    """Docker log chunks of the timeline, paced at speed times real time (0 for max)"""
+    began = time.monotonic()
+    last = 0.0
+    for at, text in timeline:
+        if speed > 0:
+            delay = began + at / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        # keep them unique, they identify the line
+        last = max(time.time(), last + 1e-6)
+        stamp = docker_timestamp(last)
+        data = f"{stamp} {text}\r\n".encode("utf-8")
+        if byte_mode:  # like a tty, which q3server has
+            for i in range(len(data) - 1):
+                yield data[i : i + 1]
+            with probe.lock:
+                probe.sent[stamp] = time.monotonic()
+            yield data[-1:]
+        else:
+            with probe.lock:
+                probe.sent[stamp] = time.monotonic()
+            yield data
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of sorted values"""
+    if len(values) == 0:
+        return float("nan")
+    return values[min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))]
+
+
+def cleanup(r, src, server):
+    """Remove what a run wrote: the server's log, and its retained state"""
+    r.delete(server_key(LOG_KEY, server))
+    src.publish(server_topic("state", server), b"", qos=1, retain=True).wait_for_publish()
+
+
+def run(timeline, speed, r, src_factory, server="loadtest", byte_mode=True, batch_size=100):
+    """Replay a timeline once; returns a dict of results"""
+    probe = Probe(server)
+    src = src_factory(probe.on_mqtt_message)
+    writer = Writer(src, r, "mqtt", [server], index=False)
+    lines = StageQueue("lines", 10000)
+    parsed = StageQueue("parsed", 10000)
+    threading.Thread(
+        target=parse_stage, args=(lines, parsed, batch_size), name="parse", daemon=True
+    ).start()
+
+    def feed():
+        for line in assemble_lines(chunks(timeline, speed, probe, byte_mode)):
+            lines.put((server, line.decode("utf-8").strip()))
+        lines.put((server, None))
+
+    began = time.monotonic()
+    threading.Thread(target=feed, name="replay", daemon=True).start()
+    while True:
+        batch = parsed.get_batch(batch_size)
+        writer.write([(srv, obj) for srv, obj in batch if obj is not None])
+        if any(obj is None for _, obj in batch):
+            break
+    written = time.monotonic() - began
+
+    # until the last deliveries are in
+    deadline = time.monotonic() + 10
+    seen = -1
+    while time.monotonic() < deadline and len(probe.latencies) != seen:
+        seen = len(probe.latencies)
+        time.sleep(0.5)
+
+    cleanup(r, src, server)
+
+    latencies = sorted(probe.latencies)
+    return {
+        "speed": speed,
+        "lines": len(timeline),
+        "delivered": len(latencies),
+        "seconds": written,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if len(latencies) > 0 else float("nan"),
+    }
+
+
+def mqtt_factory(host, server="loadtest"):
+    """Writer and subscriber clients on a real broker"""
+    import paho.mqtt.client as mqtt
+
+    def factory(on_message):
+        run_id = f"{time.monotonic_ns():x}"
+        sub = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, f"q3loadtest-probe-{run_id}")
+        sub.on_message = on_message
+        sub.connect(host)
+        sub.subscribe(server_topic("log/#", server), qos=2)
+        sub.loop_start()
+        pub = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, f"q3loadtest-{run_id}")
+        pub.connect(host)
+        pub.loop_start()
+        return pub
+
+    return factory
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a log through the q3container pipeline")
+    parser.add_argument("log", nargs="?", help="captured log; default a synthetic bot match")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        nargs="+",
+        default=[0],
+        help="multiples of real time, one run each; 0 is as fast as possible",
+    )
+    parser.add_argument("--players", type=int, default=32, help="synthetic match size")
+    parser.add_argument("--minutes", type=float, default=10, help="synthetic match length")
+    parser.add_argument("--kill-rate", type=float, default=4, help="synthetic kills per second")
+    parser.add_argument("--lines", action="store_true", help="whole lines, instead of tty bytes")
+    parser.add_argument("--in-process", action="store_true", help="fakeredis and a loopback broker")
+    args = parser.parse_args()
+
+    if args.log is not None:
+        timeline = read_timeline(args.log)
+    else:
+        timeline = synthetic_match(args.players, args.minutes, args.kill_rate, seed=1)
+    duration = timeline[-1][0] if any(timeline) else 0.0
+    print(f"{len(timeline)} lines over {duration:.0f}s of game time")
+
+    if args.in_process:
+        try:
+            import fakeredis
+        except ImportError:
+            print("--in-process needs fakeredis (pip install fakeredis)")
+            return 1
+        factory = Loopback
+    else:
+        factory = mqtt_factory(CONFIG.get("mqtt", "localhost"))
+
+    print(f"{'speed':>6} {'lines/s':>9} {'events':>7}   p50 ms   p90 ms   p99 ms   max ms")
+    for speed in args.speed:
+        r = fakeredis.FakeRedis() if args.in_process else redis_client()
+        res = run(timeline, speed, r, factory, byte_mode=not args.lines)
+        print(
+            f"{'max' if speed == 0 else f'{speed:g}x':>6}"
+            f" {res['lines'] / res['seconds']:9.0f} {res['delivered']:7d}"
+            + "".join(f" {res[k] * 1000:8.1f}" for k in ("p50", "p90", "p99", "max"))
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
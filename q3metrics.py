@@ -0,0 +1,165 @@
+"""Counters, gauges and latency histograms, served in Prometheus text format
+
+Metrics are module-level objects in the code they measure, e.g.
+
+    LINES = Counter("q3container_lines_parsed_total", "Lines parsed", ["action"])
+    LINES.inc(action="Kill")
+
+and start_server() exposes everything registered on /metrics.
+"""
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+REGISTRY = list()
+# seconds; covers a sub-millisecond parse up to a Discord send under rate limiting
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_labels(names, values, extra=None):
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values, strict=True)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{escape(extra[1])}"')
+    return "{" + ",".join(pairs) + "}" if any(pairs) else ""
+
+
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = dict()  # label values -> value
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def samples(self):
+        """Yields (suffix, label values, extra label, value)"""
+        with self.lock:
+            items = list(self.values.items())
+        for k, v in items:
+            yield "", k, None, v
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, k, extra, v in self.samples():
+            lines.append(f"{self.name}{suffix}{render_labels(self.labelnames, k, extra)} {v}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        k = self.key(labels)
+        with self.lock:
+            self.values[k] = self.values.get(k, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, doc, labels=()):
+        super().__init__(name, doc, labels)
+        self.functions = dict()
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def set_function(self, fn, **labels):
+        """Sample fn() at scrape time instead, e.g. for the length of a queue"""
+        with self.lock:
+            self.functions[self.key(labels)] = fn
+
+    def samples(self):
+        yield from super().samples()
+        with self.lock:
+            functions = list(self.functions.items())
+        for k, fn in functions:
+            yield "", k, None, fn()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        k = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(k, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.values[k] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            items = [(k, (list(counts), total)) for k, (counts, total) in self.values.items()]
+        for k, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts, strict=False):
+                cumulative += count
+                yield "_bucket", k, ("le", bound), cumulative
+            cumulative += counts[-1]
+            yield "_bucket", k, ("le", "+Inf"), cumulative
+            yield "_sum", k, None, total
+            yield "_count", k, None, cumulative
+
+
+def render():
+    return "\n".join(m.render() for m in REGISTRY) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start_server(port, host=""):
+    """Serve /metrics from a daemon thread; port 0 disables it"""
+    if port == 0:
+        return None
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="q3metrics", daemon=True).start()
+    logger.info(f"Serving metrics on {host or '*'}:{port}")
+    return server
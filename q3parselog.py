@@ -1,15 +1,25 @@
+import bisect
+from datetime import datetime, timedelta
 from io import StringIO
 import json
 import logging
 import operator
+import zlib
 
 from dateutil.parser import parse
-import redis
 
-from q3constants import CONFIG, IX_WORLD, MOD_TO_WEAPON, TZ, is_bot
+from q3constants import CONFIG, IX_WORLD, MOD_TO_WEAPON, TZ, is_bot, redis_client, server_key
 
 logger = logging.getLogger(__name__)
 
+LOG_KEY = "q3log"
+COMPACT_KEY = "q3games"  # start timestamp -> compressed game record
+TRIMMED_KEY = "q3log_trimmed"  # number of lines trimmed off the head of LOG_KEY
+
+MESSAGE_SIZE = 2000  # Discord's message size limit
+FOOTER_ROOM = 40  # for a page's footer
+MORE_ROOM = 20  # for the line saying how many victims were left out
+
 
 def render_name(name):
     if name is None:
@@ -20,6 +30,16 @@ def render_name(name):
         return name
 
 
+def render_leaderboard(mapname, board):
+    """One message with a map leaderboard, from map_leaderboard"""
+    if not any(board):
+        return f"No games recorded on {mapname}"
+    lines = [f"**{mapname}**"]
+    for i, (pl, score, games, wins) in enumerate(board, start=1):
+        lines.append(f" {i}) {render_name(pl)}: _{score}_ kills in {games} games, {wins} wins")
+    return "\n".join(lines)
+
+
 def find_winners(scores):
     winscore = max(scores.values())
     return [k for k, v in scores.items() if v == winscore]
@@ -32,17 +52,109 @@ def render_winners(winners):
         return f"{', '.join(map(render_name, winners))} (shared victory)"
 
 
+def game_to_record(game):
+    """Serialize a finished game to a compact, compressed record"""
+    rec = dict(game)
+    for k in ("started", "ended"):
+        if k in rec:
+            rec[k] = rec[k].isoformat()
+    if "duration" in rec:
+        rec["duration"] = rec["duration"].total_seconds()
+
+    return zlib.compress(json.dumps(rec).encode("utf-8"))
+
+
+def game_from_record(record):
+    """Inverse of game_to_record"""
+    game = json.loads(zlib.decompress(record).decode("utf-8"))
+    for k in ("started", "ended"):
+        if k in game:
+            game[k] = datetime.fromisoformat(game[k]).astimezone(TZ)
+    if "duration" in game:
+        game["duration"] = timedelta(seconds=game["duration"])
+
+    return game
+
+
+def events_since(r, timestamp, server=None, chunk=1000):
+    """Events logged after a timestamp, oldest first, reading back from the tail
+
+    Returns a list of (action, payload).
+    """
+    log_key = server_key(LOG_KEY, server)
+    events = list()
+    end = -1
+    while True:
+        lines = r.lrange(log_key, end - chunk + 1, end)
+        for robj in reversed(lines):
+            message = json.loads(robj)
+            try:
+                payload = json.loads(message["content"])
+            except json.decoder.JSONDecodeError:
+                continue
+            if payload["timestamp"] <= timestamp:
+                events.reverse()
+                return events
+            events.append((message["action"], payload))
+        if len(lines) < chunk:  # reached the head of the log
+            events.reverse()
+            return events
+        end -= chunk
+
+
+def last_game_lines(r, server=None, chunk=1000):
+    """The raw log from its last InitGame on, reading back from the tail
+
+    Returns (log offset of the InitGame, lines), or (offset after the end, []) if
+    there's no InitGame left in the raw log.
+    """
+    log_key = server_key(LOG_KEY, server)
+    pipe = r.pipeline()
+    pipe.get(server_key(TRIMMED_KEY, server))
+    pipe.llen(log_key)
+    trimmed, length = pipe.execute()
+    end = int(trimmed or 0) + length  # log offset after the last line
+    tail = list()
+    while len(tail) < length:
+        lines = r.lrange(log_key, -len(tail) - chunk, -len(tail) - 1)
+        if len(lines) == 0:
+            break
+        for i in range(len(lines) - 1, -1, -1):
+            if json.loads(lines[i])["action"] == "InitGame":
+                tail = lines[i:] + tail
+                return end - len(tail), tail
+        tail = lines + tail
+    return end, list()
+
+
 class Q3LogParse(object):
-    def __init__(self):
-        rhost = CONFIG.get("redishost", "q3redis")
-        rport = int(CONFIG.get("redisport", "6379"))
-        rdb = int(CONFIG.get("redisdb", "0"))
-        self.r = redis.Redis(host=rhost, port=rport, db=rdb)
+    def __init__(self, r=None, sinks=None, keep_games=True, server=None):
+        """
+        Args:
+            r: Redis client, defaults to one from the config
+            sinks: Objects with a game_finished(ts, game) method, called as each
+                   game finishes (i.e. once per game when following the log)
+            keep_games: Set to False to forget games once the sinks have seen them
+            server: Game server name, when following several
+        """
+        if r is None:
+            r = redis_client()
+        self.r = r
+        self.log_key = server_key(LOG_KEY, server)
+        self.compact_key = server_key(COMPACT_KEY, server)
+        self.trimmed_key = server_key(TRIMMED_KEY, server)
+        self.sinks = sinks or list()
+        self.keep_games = keep_games
         self.scores = dict()
         self.games = dict()
+        # start timestamps of the finished games, sorted, for range queries by time
+        self.starts = list()
         self.last_start = None
         self.last_map = None
         self.last_safe_idx = None
+        self.game_offsets = dict()  # start timestamp -> log offset of InitGame
+        self.last_timestamp = None  # of the last event handled, as logged
+        self.version = 0  # counts finished games, to tell when stats change
 
     def handle_message(self, idx, message):
         payload = message["content"]
@@ -52,9 +164,14 @@ class Q3LogParse(object):
             logger.error(f"{payload} isn't JSON")
             return True
 
-        tokens = (None, None, message["action"])
+        return self.handle_event(idx, message["action"], payload)
+
+    def handle_event(self, idx, action, payload):
+        """Handle one event; payload is the decoded content, and may be kept"""
+        tokens = (None, None, action)
 
         ts = parse(payload["timestamp"]).astimezone(TZ)
+        self.last_timestamp = payload["timestamp"]
         curts = self.last_start
         # This is the action!
         if tokens[2] == "ShutdownGame":  # happens after the scores have been published
@@ -69,6 +186,7 @@ class Q3LogParse(object):
                     f"Game {self.last_map}@{ts} had {len(self.scores)} players,"
                     f" and {render_winners(winners)} won"
                 )
+                self.game_finished(curts)
             else:
                 if curts in self.games:
                     del self.games[curts]
@@ -78,9 +196,13 @@ class Q3LogParse(object):
             self.last_start = None
         elif tokens[2] == "InitGame":
             # Start of game
+            if not self.keep_games and curts in self.games:
+                self.forget_game(curts)  # never finished
+            self.unindex_game(ts)  # the same game again, it's not finished yet
             self.last_start = ts
             self.last_map = payload["mapname"]
             self.last_safe_idx = idx
+            self.game_offsets[ts] = idx
             self.games[ts] = payload
             self.games[ts]["started"] = ts
 
@@ -90,6 +212,7 @@ class Q3LogParse(object):
             self.games[ts]["winners"] = list()
             self.games[ts]["kills"] = dict()
             self.games[ts]["weapons"] = dict()
+            self.games[ts]["duels"] = dict()  # player -> target -> weapon -> kills
         elif tokens[2] == "Exit":
             # At end of gameplay, but before scores are published
             if curts in self.games:
@@ -115,8 +238,39 @@ class Q3LogParse(object):
 
                     self.games[curts]["weapons"][name_][mod] += 1
 
+                    duels = self.games[curts]["duels"].setdefault(name_, dict())
+                    duels.setdefault(tgt_, dict()).setdefault(mod, 0)
+                    duels[tgt_][mod] += 1
+
         return True
 
+    def game_finished(self, ts):
+        self.version += 1
+        self.index_game(ts)
+        for sink in self.sinks:
+            try:
+                sink.game_finished(ts, self.games[ts])
+            except Exception as ex:
+                logger.exception(f"{sink} failed on game {ts}", exc_info=ex)
+
+        if not self.keep_games:
+            self.forget_game(ts)
+
+    def forget_game(self, ts):
+        del self.games[ts]
+        self.game_offsets.pop(ts, None)
+        self.unindex_game(ts)
+
+    def index_game(self, ts):
+        ix = bisect.bisect_left(self.starts, ts)
+        if ix == len(self.starts) or self.starts[ix] != ts:
+            self.starts.insert(ix, ts)  # at the end, unless games arrive out of order
+
+    def unindex_game(self, ts):
+        ix = bisect.bisect_left(self.starts, ts)
+        if ix < len(self.starts) and self.starts[ix] == ts:
+            del self.starts[ix]
+
     def player_meta(self, since=None):
         """
         Get:
@@ -129,12 +283,7 @@ class Q3LogParse(object):
         plgames = dict()
         plweapons = dict()
 
-        for gts, data in self.games.items():
-            if since is not None and gts < since:
-                continue
-            if "scores" not in data:
-                continue
-
+        for gts, data in self.finished_games(since):
             for pl, score in data["scores"].items():
                 plgames.setdefault(pl, dict()).setdefault("games", list())
                 plgames[pl].setdefault("mapscore", dict())
@@ -197,64 +346,80 @@ class Q3LogParse(object):
             )
         }
 
-    def stats_text(self, since=None):
-        if since is not None and since.tzinfo is None:
-            since = TZ.localize(since)
-        player_kills, player_games, player_weapons = self.player_meta(since)
-        player_wins = self.player_wins(player_games)
-        first_game = min(self.games.keys())
-        since_ = max(first_game, since) if since is not None else first_game
-        sincegames = list(filter(lambda x: x >= since_, self.games.keys()))
-        yield (
-            f"**{len(sincegames)}** games recorded since "
-            f"{since_:%Y-%m-%d %H:%M}, "
-            f"_{len(player_kills)}_ players\n"
-        )
-
-        for winner, wins_ in player_wins.items():
-            output = StringIO()
-            frac, wins, games, bestmap = wins_
-            winner_ = render_name(winner)
-            weapons_ = sorted(
-                player_weapons[winner].items(),
-                key=operator.itemgetter(1),
-                reverse=True,
-            )
-
-            map_part = f"Best map: _{bestmap}_\n" if bestmap is not None else ""
-
-            weap_part = (
-                f"Favourite weapon: {weapons_[0][0]} (_{weapons_[0][1]}_ kills)\n"
-                if len(weapons_) > 0
-                else ""
-            )
+    def finished_games(self, since=None):
+        """(start, game) of the finished games, oldest first, optionally since some datetime"""
+        first = bisect.bisect_left(self.starts, since) if since is not None else 0
+        for ix in range(first, len(self.starts)):
+            ts = self.starts[ix]
+            yield ts, self.games[ts]
+
+    def snapshot(self):
+        """A copy holding just the finished games, which are no longer changed, so it
+        can be read on another thread while this one is fed"""
+        copy = Q3LogParse(self.r)
+        copy.games = dict(self.finished_games())
+        copy.starts = list(self.starts)
+        copy.version = self.version
+        return copy
+
+    def first_game(self):
+        """Start of the first finished game, or None"""
+        return self.starts[0] if any(self.starts) else None
+
+    def game_count(self, since=None):
+        if since is None:
+            return len(self.starts)
+        return len(self.starts) - bisect.bisect_left(self.starts, since)
+
+    def map_leaderboard(self, mapname, since=None, count=10):
+        """Best total scores on a map: [(player, score, games, wins)]"""
+        board = dict()
+        for _, game in self.finished_games(since):
+            if game["mapname"] != mapname:
+                continue
+            for pl, score in game["scores"].items():
+                row = board.setdefault(pl, [pl, 0, 0, 0])
+                row[1] += score
+                row[2] += 1
+                row[3] += pl in game["winners"]
+        rows = sorted(board.values(), key=operator.itemgetter(1), reverse=True)
+        return [tuple(row) for row in rows[:count]]
 
-            output.write(
-                f"\n**{winner_}**: {wins} wins in {games} games"
-                f" ({100 * frac:.0f}% win ratio)\n"
-                f"{map_part}"
-                f"{weap_part}"
-            )
-            targets_ = dict(
-                sorted(
-                    player_kills[winner].items(),
-                    key=operator.itemgetter(1),
-                    reverse=True,
-                )
-            )
-            self.stringify_kills(output, targets_)
+    def stats_text(self, since=None):
+        pages = StatsPages(self, since)
+        yield pages.header()
+
+        for player in pages.player_wins:
+            yield pages.player_text(player)
+
+    def load_compacted(self, records):
+        """Load compacted game records (start timestamp -> record), oldest first"""
+        games = [game_from_record(rec) for rec in records.values()]
+        for game in sorted(games, key=lambda g: g["started"]):
+            self.games[game["started"]] = game
+            if "scores" in game:
+                self.index_game(game["started"])
+
+    def parse_lines(self, lines, offset=0):
+        """Parse raw log lines; offset is the absolute log position of the first line"""
+        for ix, ln in enumerate(lines):
+            self.handle_message(offset + ix, json.loads(ln.decode("utf-8")))
 
-            output.seek(0)
-            yield output.read()
+    def drop_orphans(self):
+        """Clean up orphaned games, keeping any game still in progress"""
+        to_delete = list()
+        for ts, game in self.games.items():
+            if "scores" not in game and ts != self.last_start:
+                to_delete.append(ts)
 
-    def stringify_kills(self, output, targets_):
-        i = 1
-        for target, kills in targets_.items():
-            target_ = render_name(target)
-            output.write(f" {i}) {target_}: _{kills}_ kills\n")
-            i += 1
+        for ts in to_delete:
+            del self.games[ts]
 
     def parse_log(self):
+        """Read compacted games and the raw log; compaction doesn't change the results
+
+        Returns the log offset after the last line read, to follow on from.
+        """
         # already_parsed = self.r.get("q3log_lastparse")
         parse_from = 0
         # if already_parsed is not None:
@@ -265,19 +430,159 @@ class Q3LogParse(object):
         # if log_len is not None:
         #     parse_to = int(log_len)
 
-        lines = self.r.lrange("q3log", parse_from, parse_to)
+        # read everything in one transaction, so a concurrent compaction can't split it
+        pipe = self.r.pipeline()
+        pipe.hgetall(self.compact_key)
+        pipe.get(self.trimmed_key)
+        pipe.lrange(self.log_key, parse_from, parse_to)
+        records, trimmed, lines = pipe.execute()
+
+        self.load_compacted(records)
+        self.parse_lines(lines, int(trimmed or 0))
+        self.drop_orphans()
+        return int(trimmed or 0) + len(lines)
+
+
+def count_wins(plgames):
+    """Like Q3LogParse.player_wins, for player_meta with games and wins as counts"""
+    plwin_ = list()
+    for pl, data in plgames.items():
+        games = data["games"]
+        wins = data["wins"]
+        bestmap = max(data["mapscore"].items(), key=operator.itemgetter(1))[0]
+        plwin_.append((pl, wins / games, wins, games, bestmap))
+
+    return {
+        pl: (frac, wins, games, bestmap)
+        for pl, frac, wins, games, bestmap in sorted(
+            plwin_, key=operator.itemgetter(1), reverse=True
+        )
+    }
 
-        for ix, ln in enumerate(lines):
-            self.handle_message(ix, json.loads(ln.decode("utf-8")))
 
-        # Clean up orphaned games
-        to_delete = list()
-        for ts, game in self.games.items():
-            if "scores" not in game:
-                to_delete.append(ts)
+class StatsPages(object):
+    """Stats for a period, aggregated once and rendered a page at a time"""
 
-        for ts in to_delete:
-            del self.games[ts]
+    def __init__(self, parsed, since=None, per_page=None, top=None):
+        """
+        Args:
+            parsed: Q3LogParse with the games loaded, or another stats backend
+                    with the same player_meta/player_wins/first_game/game_count
+            since: Only count games since this datetime
+            per_page: Players per page after the summary, default stats_per_page
+            top: Players in the summary, default stats_top
+        """
+        if since is not None and since.tzinfo is None:
+            since = TZ.localize(since)
+        self.per_page = per_page or int(CONFIG.get("stats_per_page", "4"))
+        self.top = top or int(CONFIG.get("stats_top", "10"))
+        self.player_kills, player_games, self.player_weapons = parsed.player_meta(since)
+        self.player_wins = parsed.player_wins(player_games)
+        first_game = parsed.first_game()
+        self.since = max(first_game, since) if since is not None else first_game
+        self.game_count = parsed.game_count(self.since)
+        self.players = list(self.player_wins)
+        self.player_pages = self.paginate()
+
+    def header(self):
+        return (
+            f"**{self.game_count}** games recorded since "
+            f"{self.since:%Y-%m-%d %H:%M}, "
+            f"_{len(self.player_kills)}_ players\n"
+        )
+
+    def player_text(self, player, limit=None):
+        """One player's stats; with limit, victims are left out to fit in that many characters"""
+        output = StringIO()
+        frac, wins, games, bestmap = self.player_wins[player]
+        player_ = render_name(player)
+        weapons_ = sorted(
+            self.player_weapons.get(player, dict()).items(),
+            key=operator.itemgetter(1),
+            reverse=True,
+        )
+
+        map_part = f"Best map: _{bestmap}_\n" if bestmap is not None else ""
+
+        weap_part = (
+            f"Favourite weapon: {weapons_[0][0]} (_{weapons_[0][1]}_ kills)\n"
+            if len(weapons_) > 0
+            else ""
+        )
+
+        output.write(
+            f"\n**{player_}**: {wins} wins in {games} games"
+            f" ({100 * frac:.0f}% win ratio)\n"
+            f"{map_part}"
+            f"{weap_part}"
+        )
+        targets_ = dict(
+            sorted(
+                self.player_kills.get(player, dict()).items(),
+                key=operator.itemgetter(1),
+                reverse=True,
+            )
+        )
+        self.stringify_kills(output, targets_, limit)
+
+        output.seek(0)
+        return output.read()
+
+    def stringify_kills(self, output, targets_, limit=None):
+        i = 1
+        for target, kills in targets_.items():
+            target_ = render_name(target)
+            line = f" {i}) {target_}: _{kills}_ kills\n"
+            if limit is not None and output.tell() + len(line) + MORE_ROOM > limit:
+                output.write(f" _and {len(targets_) - i + 1} more_\n")
+                break
+            output.write(line)
+            i += 1
+
+    def paginate(self):
+        """Players' texts grouped into pages of at most per_page players, starting a new
+        page before one would overflow a message"""
+        room = MESSAGE_SIZE - FOOTER_ROOM
+        pages = list()
+        page = list()
+        size = 0
+        for player in self.players:
+            text = self.player_text(player, room)
+            if any(page) and (len(page) >= self.per_page or size + len(text) > room):
+                pages.append(page)
+                page = list()
+                size = 0
+            page.append(text)
+            size += len(text)
+        if any(page):
+            pages.append(page)
+        return pages
+
+    @property
+    def page_count(self):
+        """The summary, then the players' pages"""
+        return 1 + len(self.player_pages)
+
+    def summary(self):
+        output = StringIO()
+        output.write(self.header())
+        for i, player in enumerate(self.players[: self.top], start=1):
+            frac, wins, games, _ = self.player_wins[player]
+            output.write(
+                f" {i}) **{render_name(player)}**: {wins} wins in {games} games"
+                f" ({100 * frac:.0f}%)\n"
+            )
+        output.seek(0)
+        return output.read()
+
+    def page(self, number):
+        """Render one page; 0 is the summary"""
+        if number == 0:
+            text = self.summary()
+        else:
+            text = "".join(self.player_pages[number - 1])
+        footer = f"\n_page {number + 1}/{self.page_count}_"
+        return text[: MESSAGE_SIZE - len(footer)] + footer  # only ever cuts the summary
 
 
 def main():
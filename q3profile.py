@@ -0,0 +1,134 @@
+"""On-demand profiling of hot paths
+
+A Profiler is idle until started, for a number of calls or seconds. While active,
+every section() runs under cProfile, with tracemalloc sampling allocations. When
+done, the profile and allocation stats are dumped to a directory, and a top-N
+summary is handed to on_finish (to be posted/published by the caller).
+"""
+
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+from io import StringIO
+import logging
+from pathlib import Path
+import pstats
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler(object):
+    def __init__(self, name, outdir="profiles", top=10, on_finish=None):
+        """
+        Args:
+            name: Used in dump file names and the summary
+            outdir: Directory for the dumps
+            top: Number of functions/allocation sites in the summary
+            on_finish: Called with the summary text when a profiling run ends
+        """
+        self.name = name
+        self.outdir = Path(outdir)
+        self.top = top
+        self.on_finish = on_finish
+        self.lock = threading.Lock()
+        self.section_lock = threading.RLock()
+        self.profile = None
+        self.calls_left = None
+        self.deadline = None
+        self.calls = 0
+        self.started = None
+
+    @property
+    def active(self):
+        return self.profile is not None
+
+    def start(self, calls=None, seconds=None):
+        """Profile the next `calls` sections, or all sections for `seconds`"""
+        with self.lock:
+            if self.active:
+                return False
+            self.profile = cProfile.Profile()
+            self.calls_left = calls
+            self.deadline = time.monotonic() + seconds if seconds is not None else None
+            self.calls = 0
+            self.started = time.monotonic()
+            tracemalloc.start()
+        logger.info(f"Profiling {self.name} for {calls or seconds} {'calls' if calls else 's'}")
+        return True
+
+    @contextmanager
+    def section(self):
+        """Profile the enclosed code if profiling is active; nearly free otherwise
+
+        cProfile only records the thread that enables it, so sections in several
+        threads all count, but while profiling they run one at a time.
+        """
+        if self.profile is None:
+            yield
+            return
+
+        with self.section_lock:
+            profile = self.profile
+            if profile is None:  # stopped while we waited
+                yield
+                return
+
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                self.calls += 1
+                if self.calls_left is not None:
+                    self.calls_left -= 1
+                # an idle section never gets here, so a timed run ends on the next call after it
+                if (self.calls_left is not None and self.calls_left <= 0) or (
+                    self.deadline is not None and time.monotonic() > self.deadline
+                ):
+                    self.stop()
+
+    def stop(self):
+        with self.lock:
+            if not self.active:
+                return None
+            profile, self.profile = self.profile, None
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+        elapsed = time.monotonic() - self.started
+        self.outdir.mkdir(parents=True, exist_ok=True)
+        stem = self.outdir / f"{self.name}-{datetime.now():%Y%m%d-%H%M%S}"
+        profile.dump_stats(f"{stem}.prof")
+        snapshot.dump(f"{stem}.tracemalloc")
+
+        summary = self.summarize(profile, snapshot, elapsed)
+        logger.info(f"Profile of {self.name} written to {stem}.*\n{summary}")
+        if self.on_finish is not None:
+            self.on_finish(summary)
+        return summary
+
+    def summarize(self, profile, snapshot, elapsed):
+        stats = pstats.Stats(profile)
+        output = StringIO()
+        output.write(
+            f"Profile of {self.name}: {self.calls} calls in {elapsed:.1f}s,"
+            f" {stats.total_tt:.3f}s profiled\n"
+            f"Top {self.top} by cumulative time:\n"
+        )
+        by_cumtime = sorted(stats.stats.items(), key=lambda kv: kv[1][3], reverse=True)
+        for (fname, line, func), (_, ncalls, _, cumtime, _) in by_cumtime[: self.top]:
+            output.write(f"{cumtime:8.3f}s {ncalls:>9}x  {Path(fname).name}:{line}({func})\n")
+
+        output.write(f"Top {self.top} allocation sites:\n")
+        for stat in snapshot.statistics("lineno")[: self.top]:
+            frame = stat.traceback[0]
+            output.write(
+                f"{stat.size / 1024:8.1f}KiB {stat.count:>9}x  "
+                f"{Path(frame.filename).name}:{frame.lineno}\n"
+            )
+
+        output.seek(0)
+        return output.read()
@@ -0,0 +1,238 @@
+"""Optional SQLite store of finished games, for indexed stats queries
+
+SQLiteStats is a Q3LogParse sink: each finished game becomes a row in games, and
+rows in scores, kills and weapon_kills, all keyed by the game's start time (in
+microseconds since the epoch). It has the same player_meta/player_wins/
+first_game/game_count/map_leaderboard as Q3LogParse, answered with indexed
+aggregates instead of a pass over every game, so StatsPages works with either.
+`python q3sqlite.py load` fills it from Redis; loading is idempotent.
+"""
+
+import argparse
+from datetime import datetime
+import logging
+import sqlite3
+import threading
+
+from q3constants import CONFIG, TZ
+from q3parselog import Q3LogParse, StatsPages, count_wins, render_leaderboard
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    start INTEGER PRIMARY KEY,
+    ended INTEGER,
+    mapname TEXT NOT NULL,
+    reason TEXT,
+    fraglimit INTEGER
+);
+CREATE INDEX IF NOT EXISTS games_map ON games (mapname, start);
+
+CREATE TABLE IF NOT EXISTS scores (
+    start INTEGER NOT NULL REFERENCES games (start),
+    player TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    winner INTEGER NOT NULL,
+    PRIMARY KEY (start, player)
+);
+CREATE INDEX IF NOT EXISTS scores_player ON scores (player, start);
+
+CREATE TABLE IF NOT EXISTS kills (
+    start INTEGER NOT NULL REFERENCES games (start),
+    player TEXT NOT NULL,
+    target TEXT NOT NULL,
+    kills INTEGER NOT NULL,
+    PRIMARY KEY (start, player, target)
+);
+CREATE INDEX IF NOT EXISTS kills_player ON kills (player, start);
+
+CREATE TABLE IF NOT EXISTS weapon_kills (
+    start INTEGER NOT NULL REFERENCES games (start),
+    player TEXT NOT NULL,
+    weapon TEXT NOT NULL,
+    kills INTEGER NOT NULL,
+    PRIMARY KEY (start, player, weapon)
+);
+CREATE INDEX IF NOT EXISTS weapon_kills_player ON weapon_kills (player, start);
+"""
+
+
+def to_us(ts):
+    """datetime to integer microseconds since the epoch, exact for use as a key"""
+    return round(ts.timestamp() * 1_000_000)
+
+
+def from_us(us):
+    return datetime.fromtimestamp(us / 1_000_000, TZ)
+
+
+class SQLiteStats(object):
+    def __init__(self, path=None):
+        """
+        Args:
+            path: Database file, defaults to sqlite_path from the config
+        """
+        self.path = path or CONFIG.get("sqlite_path", "q3stats.sqlite")
+        # fed from the log thread and queried from the bot's, one at a time
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.executescript(SCHEMA)
+
+    def query(self, sql, *params):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def game_finished(self, ts, game):
+        """Store one finished game; returns False if it was stored already"""
+        start = to_us(ts)
+        ended = to_us(game["ended"]) if "ended" in game else None
+        with self.lock, self.db:
+            cur = self.db.execute(
+                "INSERT OR IGNORE INTO games VALUES (?, ?, ?, ?, ?)",
+                (start, ended, game["mapname"], game.get("reason"), game.get("fraglimit")),
+            )
+            if cur.rowcount == 0:
+                return False
+            # rows go in the order the game dicts have, which the aggregates
+            # below use to break ties the same way Q3LogParse does
+            self.db.executemany(
+                "INSERT INTO scores VALUES (?, ?, ?, ?)",
+                [(start, pl, score, pl in game["winners"]) for pl, score in game["scores"].items()],
+            )
+            self.db.executemany(
+                "INSERT INTO kills VALUES (?, ?, ?, ?)",
+                [
+                    (start, pl, tgt, kills)
+                    for pl, dtgt in game["kills"].items()
+                    for tgt, kills in dtgt.items()
+                ],
+            )
+            self.db.executemany(
+                "INSERT INTO weapon_kills VALUES (?, ?, ?, ?)",
+                [
+                    (start, pl, mod, kills)
+                    for pl, dmod in game["weapons"].items()
+                    for mod, kills in dmod.items()
+                ],
+            )
+        return True
+
+    def load(self, games, since=None):
+        """Store finished games from a Q3LogParse, skipping those already stored
+
+        Returns the number of games stored. With since, only later games are looked at.
+        """
+        stored = 0
+        for ts in sorted(games):
+            game = games[ts]
+            if "scores" not in game or (since is not None and ts < since):
+                continue
+            stored += self.game_finished(ts, game)
+        return stored
+
+    def last_game(self):
+        """Start of the last game stored, or None"""
+        ((last,),) = self.query("SELECT MAX(start) FROM games")
+        return from_us(last) if last is not None else None
+
+    def first_game(self):
+        ((first,),) = self.query("SELECT MIN(start) FROM games")
+        return from_us(first) if first is not None else None
+
+    def game_count(self, since=None):
+        ((count,),) = self.query(
+            "SELECT COUNT(*) FROM games WHERE start >= ?", to_us(since) if since is not None else 0
+        )
+        return count
+
+    def player_meta(self, since=None):
+        """Like Q3LogParse.player_meta, but games and wins are counts, not lists"""
+        since_us = to_us(since) if since is not None else 0
+        plkill = dict()
+        plgames = dict()
+        plweapons = dict()
+
+        rows = self.query(
+            "SELECT player, COUNT(*), SUM(winner) FROM scores WHERE start >= ?"
+            " GROUP BY player ORDER BY MIN(start), MIN(rowid)",
+            since_us,
+        )
+        for pl, games, wins in rows:
+            plgames[pl] = {"games": games, "wins": wins, "mapscore": dict()}
+
+        rows = self.query(
+            "SELECT s.player, g.mapname, SUM(s.score) FROM scores s JOIN games g USING (start)"
+            " WHERE s.start >= ? GROUP BY s.player, g.mapname ORDER BY MIN(s.start), MIN(s.rowid)",
+            since_us,
+        )
+        for pl, mapname, score in rows:
+            plgames[pl]["mapscore"][mapname] = score
+
+        rows = self.query(
+            "SELECT player, target, SUM(kills) FROM kills WHERE start >= ?"
+            " GROUP BY player, target ORDER BY MIN(start), MIN(rowid)",
+            since_us,
+        )
+        for pl, tgt, kills in rows:
+            plkill.setdefault(pl, dict())[tgt] = kills
+
+        rows = self.query(
+            "SELECT player, weapon, SUM(kills) FROM weapon_kills WHERE start >= ?"
+            " GROUP BY player, weapon ORDER BY MIN(start), MIN(rowid)",
+            since_us,
+        )
+        for pl, mod, kills in rows:
+            plweapons.setdefault(pl, dict())[mod] = kills
+
+        return plkill, plgames, plweapons
+
+    def player_wins(self, plgames):
+        """Like Q3LogParse.player_wins, from the counts of player_meta"""
+        return count_wins(plgames)
+
+    def map_leaderboard(self, mapname, since=None, count=10):
+        """Best total scores on a map: [(player, score, games, wins)]"""
+        return self.query(
+            "SELECT s.player, SUM(s.score), COUNT(*), SUM(s.winner)"
+            " FROM games g JOIN scores s USING (start) WHERE g.mapname = ? AND g.start >= ?"
+            " GROUP BY s.player ORDER BY SUM(s.score) DESC, MIN(s.start), MIN(s.rowid) LIMIT ?",
+            mapname,
+            to_us(since) if since is not None else 0,
+            count,
+        )
+
+    def stats_text(self, since=None):
+        pages = StatsPages(self, since)
+        yield pages.header()
+
+        for player in pages.player_wins:
+            yield pages.player_text(player)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite store of finished games")
+    parser.add_argument("command", choices=["load", "stats", "map"])
+    parser.add_argument("name", nargs="?", help="map for the map leaderboard")
+    parser.add_argument("--db", help="database file, default sqlite_path from the config")
+    parser.add_argument("--server", help="game server name, when following several")
+    args = parser.parse_args()
+
+    store = SQLiteStats(args.db)
+    if args.command == "load":
+        parsed = Q3LogParse(server=args.server)
+        parsed.parse_log()
+        print(f"Stored {store.load(parsed.games)} games")
+    elif args.command == "stats":
+        if store.first_game() is None:
+            print("No games stored")
+            return
+        for text in store.stats_text():
+            print(text)
+    elif args.command == "map":
+        print(render_leaderboard(args.name, store.map_leaderboard(args.name)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""Redis Streams transport for log events
+
+With transport=stream, q3container does a single XADD per event instead of
+publishing to MQTT and pushing to q3log. Consumers read through consumer groups,
+so each keeps its own offset in Redis and picks up where it left off after a
+restart: the Discord bot follows new events as group "q3bot", and this module's
+main() is the stats builder, archiving every event to q3log as group "q3stats".
+"""
+
+import argparse
+import json
+import logging
+import socket
+
+from q3constants import CONFIG, redis_client, server_key
+from q3index import Indexer, all_indexes
+from q3parselog import LOG_KEY
+
+logger = logging.getLogger(__name__)
+
+STREAM_KEY = "q3stream"
+
+
+def stream_maxlen():
+    """Approximate cap on the stream length, from the config"""
+    return int(CONFIG.get("stream_maxlen", "100000"))
+
+
+def stream_fields(obj, robj):
+    """Stream entry for a parsed log line, and its q3log representation"""
+    return {"action": obj["action"], "obj": robj}
+
+
+def entry_object(fields):
+    """Inverse of stream_fields; returns the q3log representation"""
+    return fields[b"obj"].decode("utf-8")
+
+
+class StreamConsumer(object):
+    def __init__(
+        self,
+        r,
+        group,
+        handler,
+        start_id="$",
+        consumer=None,
+        count=100,
+        block=5000,
+        server=None,
+        claim_idle=60000,
+    ):
+        """Read the log stream as part of a consumer group
+
+        Args:
+            r: Redis client
+            group: Consumer group name, i.e. the offset shared by this kind of consumer
+            handler: Called with (pipeline, entry id, fields dict) for each entry; Redis
+                     writes queued on the pipeline are committed atomically with the ack.
+                     If it raises, the entry stays pending and is retried on the next start
+            start_id: Where a new group starts; "$" for new entries, "0" for everything
+            consumer: Consumer name within the group, defaults to the host name
+            count: Max entries per read
+            block: Milliseconds to block waiting for entries
+            server: Game server name, when following several
+            claim_idle: On start, take over entries another consumer in the group has left
+                        pending for this many milliseconds, like one in a container that
+                        was since recreated under a new host name
+        """
+        self.r = r
+        self.key = server_key(STREAM_KEY, server)
+        self.group = group
+        self.handler = handler
+        self.start_id = start_id
+        self.consumer = consumer or socket.gethostname()
+        self.count = count
+        self.block = block
+        self.claim_idle = claim_idle
+        self.running = False
+
+    def ensure_group(self):
+        from redis.exceptions import ResponseError
+
+        try:
+            self.r.xgroup_create(self.key, self.group, id=self.start_id, mkstream=True)
+            logger.info(f"Created consumer group {self.group} at {self.start_id}")
+        except ResponseError as ex:
+            if "BUSYGROUP" not in str(ex):
+                raise
+
+    def reset(self, entry_id):
+        """Move the group offset, to replay from (after) entry_id"""
+        self.ensure_group()
+        self.r.xgroup_setid(self.key, self.group, entry_id)
+
+    def handle(self, entries):
+        handled = 0
+        for entry_id, fields in entries:
+            pipe = self.r.pipeline()
+            try:
+                self.handler(pipe, entry_id, fields)
+            except Exception as ex:
+                logger.exception(f"Failed handling {entry_id}, leaving it pending", exc_info=ex)
+                pipe.reset()
+                continue
+            pipe.xack(self.key, self.group, entry_id)
+            pipe.execute()
+            handled += 1
+        return handled
+
+    def claim(self):
+        """Handle entries other consumers in the group read, but never acked"""
+        start = "0-0"
+        claimed = 0
+        while True:
+            res = self.r.xautoclaim(
+                self.key, self.group, self.consumer, self.claim_idle, start, count=self.count
+            )
+            start, entries = res[0], res[1]
+            entries = [(entry_id, fields) for entry_id, fields in entries if fields is not None]
+            claimed += len(entries)
+            self.handle(entries)
+            if start in (b"0-0", "0-0"):
+                break
+        if claimed > 0:
+            logger.info(f"Claimed {claimed} entries left pending in {self.group}")
+        return claimed
+
+    def run(self):
+        self.ensure_group()
+        self.running = True
+
+        # first anything delivered to us before, but never acked
+        pending = self.r.xreadgroup(self.group, self.consumer, {self.key: "0"})
+        for _, entries in pending:
+            if any(entries):
+                logger.info(f"Replaying {len(entries)} pending entries for {self.group}")
+            self.handle(entries)
+        self.claim()
+
+        while self.running:
+            res = self.r.xreadgroup(
+                self.group,
+                self.consumer,
+                {self.key: ">"},
+                count=self.count,
+                block=self.block,
+            )
+            for _, entries in res:
+                self.handle(entries)
+
+    def stop(self):
+        self.running = False
+
+
+class StatsBuilder(object):
+    """Archives stream entries to q3log, where Q3LogParse reads them, and updates indexes"""
+
+    def __init__(self, indexer=None, server=None):
+        self.indexer = indexer
+        self.log_key = server_key(LOG_KEY, server)
+
+    def __call__(self, pipe, entry_id, fields):
+        robj = entry_object(fields)
+        json.loads(robj)  # don't archive garbage
+        pipe.rpush(self.log_key, robj)
+        if self.indexer is not None:
+            self.indexer.feed(None, robj)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive the q3 log stream to q3log")
+    parser.add_argument("--group", default="q3stats", help="consumer group name")
+    parser.add_argument(
+        "--reset",
+        metavar="ID",
+        help="move the group offset to this entry id before starting (0 replays all)",
+    )
+    parser.add_argument("--server", help="game server name, when following several")
+    args = parser.parse_args()
+
+    r = redis_client()
+
+    # a new stats builder archives everything still in the stream
+    indexer = Indexer(r, all_indexes(r, args.server))
+    indexer.resume(args.server)
+    builder = StatsBuilder(indexer, args.server)
+    consumer = StreamConsumer(r, args.group, builder, start_id="0", server=args.server)
+    if args.reset is not None:
+        consumer.reset(args.reset)
+    consumer.run()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
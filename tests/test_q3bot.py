@@ -0,0 +1,89 @@
+"""The bot seeding its game state from q3container's retained state"""
+
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("discord")
+
+from q3bot import Q3Client, Ring  # noqa: E402
+
+STATE = {
+    "timestamp": "2024-01-01T12:00:03.000000000Z",
+    "game": {"mapname": "q3dm17", "fraglimit": 10},
+    "clients": {"1": {"n": "Alice", "running_score": 1}},
+}
+
+
+@pytest.fixture
+def bot():
+    """A Q3Client with just the live state, and rcon calls recorded instead of made"""
+    client = Q3Client.__new__(Q3Client)
+    client.state_lock = threading.Lock()
+    client.last_timestamp = None
+    client.replayed_until = None
+    client.seeded = False
+    client.current_game = dict()
+    client.clients = dict()
+    client.game_record = None
+    client.last_games = Ring(2)
+    client.recent_events = Ring(10)
+    client.game_status_change = False
+    client.status_checked = 0.0
+    client.rcon_calls = 0
+
+    def rcon_getstatus():
+        client.rcon_calls += 1
+        return {b"mapname": b"q3dm6"}, list()
+
+    client.rcon_getstatus = rcon_getstatus
+    return client
+
+
+def test_seeds_everything_on_connect(bot):
+    assert bot.seed_state(STATE)
+    assert bot.current_game["mapname"] == "q3dm17"
+    assert bot.clients == STATE["clients"]
+    assert bot.last_timestamp == bot.replayed_until == STATE["timestamp"]
+    assert bot.game_status_change
+
+
+def test_keeps_a_newer_snapshot(bot):
+    bot.last_timestamp = "2024-01-01T12:00:05.000000000Z"
+    bot.clients = {"2": {"n": "Bob"}}
+    bot.seed_state(STATE)
+    assert bot.clients == {"2": {"n": "Bob"}}
+    assert bot.current_game["mapname"] == "q3dm17"  # the map was missing
+
+
+def test_later_states_only_fill_in_the_map(bot):
+    bot.seed_state(STATE)
+    bot.clients = {"2": {"n": "Bob"}}
+    bot.seed_state({**STATE, "timestamp": "2024-01-01T12:00:09.000000000Z"})
+    assert bot.clients == {"2": {"n": "Bob"}}
+
+
+def test_no_rcon_between_games(bot):
+    bot.seed_state(STATE)
+    bot.game_status_change = False
+    said = list()
+
+    def say(msg, kind=None):
+        said.append(msg)
+
+    for action, payload in [
+        ("Exit", {"reason": "Fraglimit hit.", "timestamp": "2024-01-01T12:01:00Z"}),
+        ("ShutdownGame", {"timestamp": "2024-01-01T12:01:05Z"}),
+    ]:
+        bot.apply_event(action, payload, say)
+        asyncio.run(bot.ensure_status())
+    assert bot.rcon_calls == 0
+
+    # but it does ask when the map stays unknown
+    bot.status_checked = 0.0
+    bot.game_status_change = False
+    bot.change_presence = lambda **kwargs: asyncio.sleep(0)
+    asyncio.run(bot.ensure_status())
+    assert bot.rcon_calls == 1
+    assert bot.current_game["mapname"] == "q3dm6"
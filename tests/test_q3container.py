@@ -0,0 +1,77 @@
+"""LiveState, and the Writer publishing it retained, with fakeredis and an in-process broker"""
+
+import json
+
+import pytest
+
+from q3container import LiveState, Writer, parse
+
+fakeredis = pytest.importorskip("fakeredis")
+
+GAME = [
+    "2024-01-01T12:00:00.000000000Z InitGame: \\sv_hostname\\x\\mapname\\q3dm17\\fraglimit\\10",
+    "2024-01-01T12:00:01.000000000Z ClientConnect: 1",
+    "2024-01-01T12:00:01.000000000Z ClientUserinfoChanged: 1 n\\Alice\\t\\0\\model\\sarge",
+    "2024-01-01T12:00:01.000000000Z ClientConnect: 2",
+    "2024-01-01T12:00:01.000000000Z ClientUserinfoChanged: 2 n\\Bob\\t\\0\\model\\sarge",
+    "2024-01-01T12:00:02.000000000Z Kill: 1 2 10: Alice killed Bob by MOD_RAILGUN",
+    "2024-01-01T12:00:03.000000000Z Kill: 2 2 7: Bob killed Bob by MOD_ROCKET_SPLASH",
+]
+
+
+class Broker(object):
+    """Keeps what's published, and the retained message per topic"""
+
+    class Published(object):
+        def wait_for_publish(self):
+            pass
+
+    def __init__(self):
+        self.messages = list()
+        self.retained = dict()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.messages.append((topic, payload))
+        if retain:
+            self.retained[topic] = payload
+        return self.Published()
+
+
+def events(lines):
+    return [parse(line) for line in lines]
+
+
+def test_live_state_follows_the_game():
+    state = LiveState()
+    for obj in events(GAME):
+        state.feed(obj["action"], json.loads(obj["content"]))
+    assert state.game["mapname"] == "q3dm17"
+    assert state.game["fraglimit"] == 10
+    assert state.clients == {
+        "1": {"n": "Alice", "running_score": 1},
+        "2": {"n": "Bob", "running_score": -1},
+    }
+    assert state.timestamp == "2024-01-01T12:00:03.000000000Z"
+
+
+def test_live_state_waits_for_a_game_start():
+    state = LiveState()
+    obj = parse(GAME[5])
+    assert not state.feed(obj["action"], json.loads(obj["content"]))
+
+
+@pytest.mark.parametrize("server, topic", [(None, "q3server/state"), ("a", "q3server/a/state")])
+def test_writer_publishes_the_state_retained(server, topic):
+    broker = Broker()
+    writer = Writer(broker, fakeredis.FakeRedis(), "mqtt", [server])
+    writer.write([(server, obj) for obj in events(GAME[:3])])
+    writer.write([(server, obj) for obj in events(GAME[3:])])
+
+    state = json.loads(broker.retained[topic])
+    assert state["game"]["mapname"] == "q3dm17"
+    assert state["clients"]["1"] == {"n": "Alice", "running_score": 1}
+    assert state["timestamp"] == "2024-01-01T12:00:03.000000000Z"
+    # one state per batch, after that batch's log topics
+    states = [i for i, (t, _) in enumerate(broker.messages) if t == topic]
+    assert len(states) == 2
+    assert states[-1] == len(broker.messages) - 1
@@ -0,0 +1,67 @@
+"""Indexer catching up on the game in progress after a restart, on fakeredis"""
+
+import pytest
+
+from q3container import parse, redis_line
+from q3index import Indexer, PlayerIndex, all_indexes
+from q3parselog import LOG_KEY, last_game_lines
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def game(minute, mapname, winner, loser):
+    ts = f"2024-01-01T12:{minute:02d}"
+    return [
+        f"{ts}:00.000000000Z InitGame: \\sv_hostname\\x\\mapname\\{mapname}\\fraglimit\\10",
+        f"{ts}:01.000000000Z Kill: 1 2 10: {winner} killed {loser} by MOD_RAILGUN",
+        f"{ts}:02.000000000Z Exit: Fraglimit hit.",
+        f"{ts}:02.000000000Z score: 1  ping: 0  client: 1 {winner}",
+        f"{ts}:02.000000000Z score: 0  ping: 0  client: 2 {loser}",
+        f"{ts}:03.000000000Z ShutdownGame:",
+    ]
+
+
+def write(r, indexer, lines):
+    """Like q3container's Writer: append to q3log, then feed the indexer"""
+    for line in lines:
+        robj = redis_line(parse(line))
+        length = r.rpush(LOG_KEY, robj)
+        if indexer is not None:
+            indexer.feed(length - 1, robj)
+
+
+@pytest.fixture
+def r():
+    return fakeredis.FakeRedis()
+
+
+def test_last_game_lines(r):
+    write(r, None, game(0, "q3dm17", "A", "B") + game(1, "q3dm6", "B", "A")[:2])
+    offset, lines = last_game_lines(r, chunk=4)
+    assert offset == 6
+    assert len(lines) == 2
+
+
+def test_last_game_lines_without_initgame(r):
+    assert last_game_lines(r) == (0, [])
+
+
+def test_resume_folds_in_the_game_running_across_a_restart(r):
+    first, second = game(0, "q3dm17", "A", "B"), game(1, "q3dm6", "B", "A")
+    write(r, Indexer(r, all_indexes(r)), first + second[:3])
+
+    # the log writer restarts in the middle of the second game
+    indexer = Indexer(r, all_indexes(r))
+    assert indexer.resume() == 3
+    write(r, indexer, second[3:])
+
+    _, data = PlayerIndex(r).lookup("b")
+    assert data[b"games"] == b"2"
+    assert data[b"wins"] == b"1"
+
+
+def test_resume_after_a_finished_game_is_a_no_op(r):
+    write(r, Indexer(r, all_indexes(r)), game(0, "q3dm17", "A", "B"))
+    Indexer(r, all_indexes(r)).resume()
+    _, data = PlayerIndex(r).lookup("a")
+    assert data[b"games"] == b"1"
@@ -0,0 +1,43 @@
+"""StatsPages pagination, on a synthetic match"""
+
+import json
+
+import pytest
+
+from q3container import parse
+from q3import import docker_timestamp
+from q3loadtest import synthetic_match
+from q3parselog import FOOTER_ROOM, MESSAGE_SIZE, Q3LogParse, StatsPages
+
+
+def played(players, minutes=5):
+    parsed = Q3LogParse(r=object())
+    start = 1704110400.0  # 2024-01-01 12:00 UTC
+    for at, text in synthetic_match(players, minutes, kills_per_second=4, seed=1):
+        obj = parse(f"{docker_timestamp(start + at)} {text}")
+        if obj is not None:
+            parsed.handle_event(None, obj["action"], json.loads(obj["content"]))
+    return parsed
+
+
+@pytest.mark.parametrize("players", [4, 30, 60])
+def test_pages_fit_and_keep_every_player(players):
+    pages = StatsPages(played(players), per_page=4, top=10)
+    texts = [pages.page(n) for n in range(pages.page_count)]
+    assert all(len(text) <= MESSAGE_SIZE for text in texts)
+    assert all(len(page) <= 4 for page in pages.player_pages)
+
+    # every player's text is on a page, whole
+    body = "".join(texts[1:])
+    for player in pages.players:
+        assert pages.player_text(player, MESSAGE_SIZE - FOOTER_ROOM) in body
+    assert sum(len(page) for page in pages.player_pages) == len(pages.players)
+
+
+def test_long_victim_lists_are_cut_between_lines():
+    pages = StatsPages(played(60, minutes=20), per_page=4, top=10)
+    player = pages.players[0]
+    text = pages.player_text(player, 500)
+    assert len(text) <= 500
+    assert text.endswith("more_\n")
+    assert len(pages.player_text(player)) > 500
@@ -0,0 +1,128 @@
+"""StreamConsumer against fakeredis, or a local redis-server with Q3_TEST_REDIS=redis://..."""
+
+import json
+import os
+import time
+import uuid
+
+import pytest
+
+from q3constants import server_key
+from q3parselog import LOG_KEY
+from q3stream import STREAM_KEY, StatsBuilder, StreamConsumer, stream_fields
+
+
+@pytest.fixture
+def r():
+    url = os.environ.get("Q3_TEST_REDIS")
+    if url:
+        import redis
+
+        client = redis.Redis.from_url(url)
+    else:
+        fakeredis = pytest.importorskip("fakeredis")
+        client = fakeredis.FakeRedis()
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def server(r):
+    """A server name of our own, so a real Redis is left as it was"""
+    name = f"test-{uuid.uuid4().hex[:8]}"
+    yield name
+    r.delete(server_key(STREAM_KEY, name), server_key(LOG_KEY, name))
+
+
+def add(r, server, n, start=0):
+    ids = list()
+    for i in range(start, start + n):
+        obj = {"action": "Kill", "timestamp": f"2024-01-01T12:00:{i:02d}+00:00", "n": i}
+        ids.append(r.xadd(server_key(STREAM_KEY, server), stream_fields(obj, json.dumps(obj))))
+    return ids
+
+
+def read(r, server, consumer, handler, **kwargs):
+    """Run a consumer until it's caught up"""
+    sc = StreamConsumer(
+        r, "q3test", handler, start_id="0", consumer=consumer, block=10, server=server, **kwargs
+    )
+    original = r.xreadgroup
+
+    def xreadgroup(*args, **kw):
+        # stop after the first blocking read that comes back empty
+        res = original(*args, **kw)
+        if kw.get("block") is not None and not any(entries for _, entries in res):
+            sc.stop()
+        return res
+
+    r.xreadgroup = xreadgroup
+    try:
+        sc.run()
+    finally:
+        del r.xreadgroup
+    return sc
+
+
+def pending(r, server):
+    return r.xpending(server_key(STREAM_KEY, server), "q3test")["pending"]
+
+
+def test_reads_and_acks(r, server):
+    ids = add(r, server, 5)
+    seen = list()
+    read(r, server, "a", lambda pipe, entry_id, fields: seen.append(entry_id))
+    assert seen == ids
+    assert pending(r, server) == 0
+
+
+def test_resumes_from_stored_offset(r, server):
+    add(r, server, 3)
+    read(r, server, "a", lambda *args: None)
+    later = add(r, server, 2, start=3)
+    seen = list()
+    read(r, server, "a", lambda pipe, entry_id, fields: seen.append(entry_id))
+    assert seen == later
+
+
+def test_failed_entries_are_replayed(r, server):
+    ids = add(r, server, 3)
+
+    def fail_second(pipe, entry_id, fields):
+        if entry_id == ids[1]:
+            raise RuntimeError("boom")
+
+    read(r, server, "a", fail_second)
+    assert pending(r, server) == 1
+
+    seen = list()
+    read(r, server, "a", lambda pipe, entry_id, fields: seen.append(entry_id))
+    assert seen == [ids[1]]
+    assert pending(r, server) == 0
+
+
+def test_claims_entries_of_a_gone_consumer(r, server):
+    ids = add(r, server, 3)
+    read(r, server, "old-host", lambda *args: 1 / 0)
+    assert pending(r, server) == 3
+
+    time.sleep(0.01)
+    seen = list()
+    read(r, server, "new-host", lambda pipe, entry_id, fields: seen.append(entry_id), claim_idle=1)
+    assert seen == ids
+    assert pending(r, server) == 0
+
+
+def test_leaves_recent_pending_entries_alone(r, server):
+    add(r, server, 2)
+    read(r, server, "other", lambda *args: 1 / 0)
+    read(r, server, "new-host", lambda *args: None)
+    assert pending(r, server) == 2
+
+
+def test_stats_builder_archives_in_the_same_transaction(r, server):
+    add(r, server, 3)
+    read(r, server, "a", StatsBuilder(server=server))
+    lines = [json.loads(line)["n"] for line in r.lrange(server_key(LOG_KEY, server), 0, -1)]
+    assert lines == [0, 1, 2]
+    assert pending(r, server) == 0